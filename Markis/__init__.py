@@ -1,5 +1,5 @@
-from .util import crowd
-from flask import Flask
+from .util import crowd, crowd_async, cache, groups
+from flask import Flask, request, session
 from flask_login import LoginManager, current_user
 from flask_principal import Principal, Permission, RoleNeed, identity_loaded, UserNeed
 
@@ -19,12 +19,38 @@ crowd_url = app.config['CROWD_API_URL']
 crowd_user = app.config['CROWD_API_USER']
 crowd_pass = app.config['CROWD_API_PASS']
 crowd_admin_group = app.config['CROWD_API_ADMIN_GROUP']
-crowdServer = crowd.Crowd(crowd_url, crowd_user, crowd_pass)
+crowdServer = crowd.Crowd(crowd_url, crowd_user, crowd_pass,
+						timeout=(app.config['CROWD_CONNECT_TIMEOUT'], app.config['CROWD_READ_TIMEOUT']),
+						pool_size=app.config['CROWD_POOL_SIZE'],
+						retries=app.config['CROWD_RETRIES'],
+						backoff=app.config['CROWD_RETRY_BACKOFF'],
+						breaker=crowd.CircuitBreaker(app.config['CROWD_BREAKER_THRESHOLD'],
+													app.config['CROWD_BREAKER_RESET']))
+# Runs independent crowd lookups at the same time, sharing the breaker with crowdServer
+parallelCrowd = crowd_async.ParallelCrowd(
+	crowd_async.AsyncCrowd(crowd_url, crowd_user, crowd_pass,
+						timeout=crowdServer.timeout,
+						pool_size=app.config['CROWD_POOL_SIZE'],
+						retries=app.config['CROWD_RETRIES'],
+						backoff=app.config['CROWD_RETRY_BACKOFF'],
+						breaker=crowdServer.breaker))
+
+# Members of the admin group (including nested groups), refreshed in the background
+admin_group = groups.GroupSnapshot(crowdServer, crowd_admin_group, app.config['ADMIN_GROUP_REFRESH_INTERVAL'])
+# Crowd profiles, so authenticated requests don't hit Crowd every time
+user_cache = cache.TTLCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+# Whether usernames and emails are taken, for the registration duplicate checks
+registration_cache = cache.TTLCache(app.config['REGISTRATION_CACHE_SIZE'], app.config['REGISTRATION_POSITIVE_TTL'])
+# Crowd session tokens that were recently validated, mapped to their username
+session_cache = cache.TTLCache(app.config['CROWD_SESSION_CACHE_SIZE'], app.config['CROWD_SESSION_VALIDATION_TTL'])
 
 
 @login_manager.user_loader
 def load_user(username):
 	try:
+		if app.config['CROWD_AUTH_MODE'] == 'session' and \
+				not validate_crowd_session(session.get('crowd_token'), username, request.remote_addr):
+			return None
 		return User(username)
 	except:
 		return None
@@ -42,11 +68,18 @@ def on_identity_loaded(sender, identity):
 			identity.provides.add(RoleNeed('admin'))
 
 
-from . import views, models
-from Markis.models import db, User
+from . import views, models, commands
+from Markis.models import db, User, validate_crowd_session
+from Markis.util.filestore import presence_index
+from Markis.util.uploads import session_collector
+from Markis.util import migrations
 
 
 def create_app():
 	db.init_app(app)
 	db.create_all()
+	migrations.migrate()
+	admin_group.start()
+	presence_index.start()
+	session_collector.start()
 	return app
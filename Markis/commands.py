@@ -0,0 +1,210 @@
+# Maintenance commands, run them with `flask <command>` (FLASK_APP=Markis)
+#
+# Please always provide a function description
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import click
+
+from . import app
+from .models import db, File
+from .util import filestore, metadata, previews, compression, scrub, util, folders, migrations
+
+
+@app.cli.command('migrate-database')
+def migrate_database():
+	"""Create the missing tables and apply the schema migrations that have not been applied yet"""
+	db.create_all()
+	applied = migrations.migrate(log=click.echo)
+	click.echo("database is at version %d, applied %d migrations" % (migrations.get_version(), len(applied)))
+
+
+@app.cli.command('migrate-filestore')
+@click.option('--batch-size', default=100, help='Number of files to move before pausing.')
+@click.option('--pause', default=1.0, help='Seconds to pause between batches.')
+def migrate_filestore(batch_size, pause):
+	"""Move files from the flat filestore into the fanned out layout, can be run while the site is online"""
+	filestore.migrate_layout(batch_size, pause, log=click.echo)
+
+
+@app.cli.command('backfill-metadata')
+@click.option('--workers', default=8, help='Number of files to read at the same time.')
+@click.option('--batch-size', default=500, help='Number of files to update per transaction.')
+def backfill_metadata(workers, batch_size):
+	"""Store the size, page count and dimensions of files uploaded before they were recorded at upload time"""
+	done = 0
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		while True:
+			files = File.query.filter(File.size.is_(None), File.file_id > done).order_by(File.file_id)\
+				.limit(batch_size).all()
+			if not files:
+				break
+			for file, file_metadata in zip(files, pool.map(read_stored_metadata, files)):
+				if file_metadata is not None:
+					for key, value in file_metadata.items():
+						setattr(file, key, value)
+					# the folders counted the file without its size
+					folders.add_size(file.subject_id, file.display_path, file.size or 0)
+			db.session.commit()
+			done = files[-1].file_id
+			click.echo("processed files up to id %d" % done)
+
+
+@app.cli.command('reconcile-scores')
+@click.option('--batch-size', default=1000, help='Number of files to recompute per transaction.')
+def reconcile_scores(batch_size):
+	"""Recompute the vote totals stored with the files from the votes, e.g. after adding the columns"""
+	last_file_id = db.session.query(db.func.max(File.file_id)).scalar() or 0
+	fixed = 0
+	for first_file_id in range(0, last_file_id + 1, batch_size):
+		fixed += util.reconcile_file_scores(first_file_id, first_file_id + batch_size - 1)
+	click.echo("recomputed the totals of files up to id %d, %d were wrong" % (last_file_id, fixed))
+
+
+@app.cli.command('rebuild-folders')
+def rebuild_folders():
+	"""Recompute the folders table from the files, e.g. after changing files in the database by hand"""
+	click.echo("rebuilt %d folders" % folders.rebuild())
+
+
+@app.cli.command('generate-previews')
+@click.option('--workers', default=2, help='Number of processes generating previews.')
+@click.option('--batch-size', default=500, help='Number of files to look up at a time.')
+def generate_previews(workers, batch_size):
+	"""Generate the previews that are missing, e.g. of files uploaded before previews existed or while the queue was full"""
+	done = 0
+	generated = 0
+	options = previews.get_preview_options()
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		while True:
+			files = File.query.filter(File.file_id > done).order_by(File.file_id).limit(batch_size).all()
+			if not files:
+				break
+			jobs = [(file.file_hash, file.type) for file in files
+					if previews.can_preview(file.type) and previews.find_preview(file.file_hash) is None]
+			for result in pool.map(generate_preview_or_none, jobs, [options] * len(jobs)):
+				if result is not None:
+					generated += 1
+			done = files[-1].file_id
+			click.echo("processed files up to id %d, %d previews generated" % (done, generated))
+
+
+@app.cli.command('compress-files')
+@click.option('--workers', default=2, help='Number of processes compressing files.')
+@click.option('--batch-size', default=500, help='Number of files to look up at a time.')
+def compress_files(workers, batch_size):
+	"""Store gzip variants of compressible files that have none, e.g. of files uploaded before variants existed"""
+	done = 0
+	stored = 0
+	options = compression.get_compression_options()
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		while True:
+			files = File.query.filter(File.file_id > done).order_by(File.file_id).limit(batch_size).all()
+			if not files:
+				break
+			file_hashes = [file.file_hash for file in files if compression.is_compressible(file.type)
+						and not os.path.isfile(filestore.get_variant_path(file.file_hash, compression.GZIP_SUFFIX))]
+			for result in pool.map(compression.compress_file, file_hashes, [options] * len(file_hashes)):
+				if result is not None:
+					stored += 1
+			done = files[-1].file_id
+			click.echo("processed files up to id %d, %d gzip variants stored" % (done, stored))
+
+
+@app.cli.command('scrub-filestore')
+@click.option('--workers', default=2, help='Number of processes hashing files.')
+@click.option('--max-rate', default=20.0, help='Max MB read per second by all workers together, 0 for no limit.')
+@click.option('--batch-size', default=1000, help='Number of files to hash between checkpoints.')
+@click.option('--checkpoint', default=None, help='File to store progress in, defaults to the instance folder.')
+@click.option('--restart', is_flag=True, help='Ignore the checkpoint and hash all files again.')
+@click.option('--min-age', default=3600, help='Seconds a file has to be old to be reported as stray or orphaned.')
+@click.option('--quarantine', default=None, help='Folder to move corrupt, orphaned and stray files to.')
+def scrub_filestore(workers, max_rate, batch_size, checkpoint, restart, min_age, quarantine):
+	"""Check that stored files match their hash and that the filestore and the database agree.
+	Reports corrupt files, files without a row, rows without a file and stray files (e.g. of uploads that died).
+	Hashing can be interrupted and continues where it stopped when started again."""
+	checkpoint = checkpoint or os.path.join(app.instance_path, 'scrub-checkpoint.json')
+	if restart and os.path.exists(checkpoint):
+		os.remove(checkpoint)
+
+	blobs, variants, strays = scrub.classify_files(min_age)
+	click.echo("found %d files, %d variants and %d strays" % (len(blobs), sum(map(len, variants.values())), len(strays)))
+	corrupt = scrub.check_hashes(blobs, checkpoint, workers, max_rate * 1024 * 1024 or None,
+								app.config['UPLOAD_CHUNK_SIZE'], batch_size, click.echo)
+
+	known_hashes = {file_hash for file_hash, in db.session.query(File.file_hash)}
+	too_new = time.time() - min_age
+	orphans = []
+	for file_hash, path in sorted(blobs.items()):
+		try:
+			# a file is stored before its row is added, so a new file may not have a row yet
+			if file_hash not in known_hashes and os.path.getmtime(path) < too_new:
+				orphans.append(file_hash)
+		except FileNotFoundError:
+			pass
+	missing = sorted(file_hash for file_hash in known_hashes
+					if file_hash not in blobs and filestore.find_file(file_hash) is None)
+	orphan_variants = sorted(file_hash for file_hash in variants if file_hash not in blobs)
+
+	for file_hash in corrupt:
+		click.echo("corrupt: %s" % blobs[file_hash])
+	for file_hash in orphans:
+		click.echo("no row: %s" % blobs[file_hash])
+	for file_id, file_hash in File.query.with_entities(File.file_id, File.file_hash).filter(File.file_hash.in_(missing)):
+		click.echo("no file: row %d (%s)" % (file_id, file_hash))
+	for file_hash in orphan_variants:
+		for path in variants[file_hash]:
+			click.echo("variant without file: %s" % path)
+	for path in strays:
+		click.echo("stray: %s" % path)
+	click.echo("%d corrupt, %d without a row, %d rows without a file, %d variants without a file, %d strays"
+			% (len(corrupt), len(orphans), len(missing), sum(len(variants[file_hash]) for file_hash in orphan_variants),
+				len(strays)))
+
+	if quarantine:
+		moved = 0
+		for file_hash in set(corrupt) | set(orphans):
+			filestore.presence_index.discard(file_hash)
+			for path in [blobs[file_hash]] + variants.get(file_hash, []):
+				if os.path.exists(path):
+					scrub.quarantine_file(path, quarantine)
+					moved += 1
+		for path in [path for file_hash in orphan_variants for path in variants[file_hash]] + strays:
+			if os.path.exists(path):
+				scrub.quarantine_file(path, quarantine)
+				moved += 1
+		click.echo("moved %d files to %s" % (moved, quarantine))
+
+	if os.path.exists(checkpoint):
+		os.remove(checkpoint)
+
+
+def generate_preview_or_none(job, options):
+	"""Generate the preview of a stored file, runs in a worker process
+		Args:
+			job: Tuple of the hash and content type of the file
+			options: Dict of preview settings, see previews.get_preview_options
+		Returns:
+			String: The path of the preview
+			None: If no preview could be generated
+	"""
+	try:
+		return previews.generate_preview(job[0], job[1], options)
+	except Exception:
+		return None
+
+
+def read_stored_metadata(file):
+	"""Read the metadata of a stored File
+		Args:
+			file: The File to read the metadata of
+		Returns:
+			Dict: The metadata of the file
+			None: If the file is not in the filestore
+	"""
+	file_path = filestore.find_file(file.file_hash)
+	if file_path is None:
+		return None
+	return metadata.read_metadata(file_path, file.type)
@@ -1,22 +1,54 @@
 from wtforms import Form, StringField, PasswordField, BooleanField, SelectField, validators, ValidationError
-from . import crowdServer
+from . import app, parallelCrowd, registration_cache
 
 
-def is_username_duplicate(username):
-	return crowdServer.user_exists(username)
+def find_duplicates(username, email):
+	"""Check whether a username and an email are already in use, only asking crowd for what is not cached
+		Args:
+			username: The username to check
+			email: The email to check
+		Returns:
+			Tuple:
+				boolean: The username exists
+				boolean: The email exists
+	"""
+	values = {'username': username, 'email': email}
+	lookups = {'username': parallelCrowd.crowd.user_exists, 'email': parallelCrowd.crowd.email_exists}
+	duplicates = {kind: registration_cache.get((kind, str(value).lower())) for kind, value in values.items()}
 
+	unknown = [kind for kind, duplicate in duplicates.items() if duplicate is None]
+	if unknown:
+		# the remaining checks are independent, so ask crowd at the same time
+		found = parallelCrowd.run(*[lookups[kind](values[kind]) for kind in unknown])
+		for kind, exists in zip(unknown, found):
+			duplicates[kind] = bool(exists)
+			remember_duplicate(kind, values[kind], duplicates[kind])
+	return duplicates['username'], duplicates['email']
 
-def is_mail_duplicate(email):
-	return crowdServer.email_exists(email)
+
+def remember_duplicate(kind, value, exists):
+	"""Store the outcome of a duplicate check, free values are only trusted for a short time
+		Args:
+			kind: 'username' or 'email'
+			value: The username or email that was checked
+			exists: Whether the value is in use
+	"""
+	ttl = app.config['REGISTRATION_POSITIVE_TTL'] if exists else app.config['REGISTRATION_NEGATIVE_TTL']
+	registration_cache.set((kind, str(value).lower()), exists, ttl=ttl)
 
 
 class RegisterForm(Form):
+	def validate(self, *args, **kwargs):
+		# check the username and email at the same time, the field validators use the outcome
+		self.username_duplicate, self.mail_duplicate = find_duplicates(self.username.data, self.email.data)
+		return super(RegisterForm, self).validate(*args, **kwargs)
+
 	def validate_email(self, field):  # here is where the magic is
-		if is_mail_duplicate(field.data):  # check if in database
+		if self.mail_duplicate:  # check if in database
 			raise ValidationError("There already exists an account with that email.")
 
 	def validate_username(self, field):  # here is where the magic is
-		if is_username_duplicate(field.data):  # check if in database
+		if self.username_duplicate:  # check if in database
 			raise ValidationError("There already exists an account with that username.")
 
 	username = StringField("Username", [validators.Length(min=3, max=100)],
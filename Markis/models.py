@@ -2,7 +2,8 @@ from flask_login import UserMixin
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import func
 
-from . import app, crowdServer, crowd_admin_group
+from . import app, crowdServer, admin_group, user_cache, session_cache
+from .util.crowd import CrowdUnavailableError
 
 db = SQLAlchemy(app)
 
@@ -27,6 +28,29 @@ class File(db.Model):
 	type = db.Column(db.String(127), unique=False, nullable=False)  # 127 is the max length according to RFC 4288
 	upload_date = db.Column(db.DATETIME, server_default=func.now(), nullable=False)
 	uploader_username = db.Column(db.String(100), nullable=False)
+	size = db.Column(db.BigInteger, nullable=True)  # in bytes, NULL for files that have not been backfilled yet
+	page_count = db.Column(db.Integer, nullable=True)  # only for PDFs
+	width = db.Column(db.Integer, nullable=True)  # only for images
+	height = db.Column(db.Integer, nullable=True)  # only for images
+	# vote totals, kept up to date by set_user_file_vote so listings never have to add up the votes
+	score = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+	upvotes = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+	downvotes = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+	# files are listed per folder, see util.get_files_to_show
+	__table_args__ = (db.Index('ix_files_subject_path', 'subject_id', 'display_path'),)
+
+
+class Folder(db.Model):
+	"""Every folder that ever held a file, with the totals of the files in it and its sub-folders,
+	so navigating a subject never has to look at the files. Kept up to date by util/folders.py."""
+	__tablename__ = 'folders'
+	subject_id = db.Column(db.String(45), nullable=False, primary_key=True)
+	path = db.Column(db.String(200), nullable=False, primary_key=True)  # display path, e.g. exams/2016-2017/answers
+	parent = db.Column(db.String(200), nullable=False)  # path of the parent folder, '' for the subject subfolders
+	file_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+	total_bytes = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+	last_upload = db.Column(db.DATETIME, nullable=True)
+	__table_args__ = (db.Index('ix_folders_subject_parent', 'subject_id', 'parent'),)
 
 
 class Faculty(db.Model):
@@ -43,26 +67,104 @@ class Vote(db.Model):
 	user_username = db.Column(db.String(100), unique=False, nullable=False, primary_key=True)
 	file_id = db.Column(db.Integer, db.ForeignKey('files.file_id'), unique=False, nullable=False, primary_key=True)
 	vote = db.Column(db.Integer, unique=False, nullable=False)
+	# the primary key starts with the user, this index serves the lookups that start with the file
+	__table_args__ = (db.Index('ix_user_file_vote_file_user', 'file_id', 'user_username'),)
 
 
 class Favorite(db.Model):
 	__tablename__ = 'user_file_favorite'
 	user_username = db.Column(db.String(100), unique=False, nullable=False, primary_key=True)
 	file_id = db.Column(db.Integer, db.ForeignKey('files.file_id'), unique=False, nullable=False, primary_key=True)
+	__table_args__ = (db.Index('ix_user_file_favorite_file_user', 'file_id', 'user_username'),)
+
+
+class SchemaVersion(db.Model):
+	"""The migrations of util/migrations.py that have been applied to the database"""
+	__tablename__ = 'schema_version'
+	version = db.Column(db.Integer, nullable=False, primary_key=True, autoincrement=False)
+	description = db.Column(db.String(200), nullable=False)
+	applied = db.Column(db.DATETIME, server_default=func.now(), nullable=False)
+
+
+def get_crowd_profile(username):
+	"""Get the crowd user data of a user, served from the user cache when possible
+		Args:
+			username: The username for which to get the profile
+		Returns:
+			Dict:
+				user: The crowd user attributes
+			None: If the user does not exist
+	"""
+	profile = user_cache.get(username)
+	if profile is not None:
+		return profile
+	try:
+		return fetch_crowd_profile(username)
+	except CrowdUnavailableError:
+		# keep known users logged in while crowd is down
+		profile = user_cache.get_stale(username)
+		if profile is None:
+			raise
+		return profile
+
+
+def fetch_crowd_profile(username):
+	"""Fetch the crowd user data of a user from crowd and store it in the user cache
+		Args:
+			username: The username for which to fetch the profile
+		Returns:
+			Dict:
+				user: The crowd user attributes
+			None: If the user does not exist
+	"""
+	crowd_user = crowdServer.get_user(username)
+	if crowd_user is None:
+		return None
+	profile = {'user': crowd_user}
+	user_cache.set(username, profile)
+	return profile
+
+
+def validate_crowd_session(token, username, remote):
+	"""Check whether a crowd session token is valid for a user, only asking crowd when the last validation expired
+		Args:
+			token: The crowd session token
+			username: The username the session should belong to
+			remote: The remote address of the user
+		Returns:
+			True: The session is valid for the user
+			False: The session is invalid, expired or belongs to someone else
+	"""
+	if token is None:
+		return False
+	if session_cache.get(token) == username:
+		return True
+
+	try:
+		crowd_session = crowdServer.validate_session(token, remote=remote)
+	except CrowdUnavailableError:
+		# trust the last validation while crowd is down
+		return session_cache.get_stale(token) == username
+	if crowd_session is None or crowd_session['user']['name'] != username:
+		session_cache.invalidate(token)
+		return False
+	session_cache.set(token, username)
+	return True
 
 
 class User:
 	def __init__(self, username):
-		if not crowdServer.user_exists(username):
+		profile = get_crowd_profile(username)
+		if profile is None:
 			raise ValueError('User %s does not exist' % username)
 
 		self.username = username
-		crowd_user = crowdServer.get_user(self.username)
+		crowd_user = profile['user']
 		self.first_name = crowd_user['first-name']
 		self.last_name = crowd_user['last-name']
 		self.displayname = crowd_user['display-name']
 		self.email = crowd_user['email']
-		self.isAdmin = crowdServer.get_groups(username).__contains__(crowd_admin_group)
+		self.isAdmin = username in admin_group
 		self.active = crowd_user['active']
 		self._authenticated = False
 
@@ -87,5 +189,21 @@ class User:
 		self._authenticated = (authenticated is not None)
 		return self._authenticated
 
+	def create_session(self, password, remote):
+		"""Authenticate the user by creating a crowd SSO session
+			Args:
+				password: The account password
+				remote: The remote address of the user
+			Returns:
+				String: The crowd session token
+				None: If authentication failed
+		"""
+		crowd_session = crowdServer.get_session(self.username, password, remote=remote)
+		self._authenticated = (crowd_session is not None)
+		if not self._authenticated:
+			return None
+		session_cache.set(crowd_session['token'], self.username)
+		return crowd_session['token']
+
 	def return_username(self):
 		return self.username
@@ -151,28 +151,17 @@ $(document).ready(()=>{
 		        }
 		      }
 				} else if (tdname == "Size") {
-					x = x.innerHTML.toLowerCase();
-					y = y.innerHTML.toLowerCase();
-					var type1 = x.replace(/[^a-zA-Z]+/g, '');
-					var type2 = y.replace(/[^a-zA-Z]+/g, '');
-					x = x.replace(/[^0-9\.]+/g, "");
-					y = y.replace(/[^0-9\.]+/g, "");
-					x = parseInt(x);
-					y = parseInt(y);
+					// compare the sizes in bytes, not the formatted sizes
+					x = parseInt(x.getAttribute("data-size")) || 0;
+					y = parseInt(y.getAttribute("data-size")) || 0;
 					if (dir == "asc") {
-						if (type1 == "mb" && type2 == "kb") {
-							shouldSwitch= true;
-		          break;
-						} else if (x > y && type1 == type2) {
+						if (x > y) {
 		          // If so, mark as a switch and break the loop:
 		          shouldSwitch= true;
 		          break;
 		        }
 		      } else if (dir == "desc") {
-						if (type1 == "kb" && type2 == "mb") {
-							shouldSwitch= true;
-		          break;
-						} else if (x < y && type1 == type2) {
+						if (x < y) {
 		          // If so, mark as a switch and break the loop:
 		          shouldSwitch= true;
 		          break;
@@ -477,6 +466,10 @@ $(document).ready(()=>{
                 }else {
                     var formData = new FormData($('#uploadForm')[0]);
                     formData.delete('files'); //remove original file field
+                    if (FileToUpload.size > $('#uploadForm').data('max-upload-size')) {
+                        uploadInChunks(FileToUpload, formData);
+                        return;
+                    }
                     formData.append("file", FileToUpload);
                     var url = $('#uploadForm').attr('action');
                     $.ajax({
@@ -487,33 +480,128 @@ $(document).ready(()=>{
                         timeout: 300000,
                         contentType: false,
                         data: formData,
-                        success: function (xhr, textStatus) {
-                            $('#uploadModal').modal('hide');
-                        },
-                        error: function (xhr, textStatus, errorThrown) {
-                            var alertText = "<strong>Warning</strong>" + xhr.responseText;
-                            if (xhr.readyState === 4) {
-                                if (xhr.status === 400) {
-                                    //Ground Control to Major Tom: "There's something wrong, Can you hear me, Major Tom?"
-                                    $('.alert').removeClass("hidden");
-                                    $("#alert-text").html(alertText);
-                                } else if (xhr.status === 500) {
-                                    $('.alert').removeClass("hidden");
-                                    $("#alert-text").html(alertText);
-                                }
-                            }
-                            else if (xhr.readyState === 0) {
-                                if (xhr.status === 413) {
-                                    $('.alert').removeClass("hidden");
-                                    $("#alert-text").html(xhr.responseText);
-
-                                }
-                            }
+                        success: uploadSuccess,
+                        error: uploadError
+                    });
+                }
+
+                });
+
+        function uploadSuccess() {
+            $('#uploadModal').modal('hide');
+        }
+
+        function uploadError(xhr) {
+            var alertText = "<strong>Warning</strong>" + xhr.responseText;
+            if (xhr.readyState === 4) {
+                if (xhr.status >= 400) {
+                    //Ground Control to Major Tom: "There's something wrong, Can you hear me, Major Tom?"
+                    $('.alert').removeClass("hidden");
+                    $("#alert-text").html(alertText);
+                }
+            }
+            else if (xhr.readyState === 0) {
+                if (xhr.status === 413) {
+                    $('.alert').removeClass("hidden");
+                    $("#alert-text").html(xhr.responseText);
+
+                }
+            }
+        }
+
+        // Files larger than MAX_UPLOAD_SIZE are sent in chunks, a few at a time, retrying failed chunks.
+        // The upload id is remembered, so choosing the same file again after a failure resumes the upload.
+        function uploadInChunks(file, formData) {
+            var key = 'upload:' + [file.name, file.size, file.lastModified, formData.get('subject'),
+                formData.get('filetype'), formData.get('opt1'), formData.get('opt2')].join(':');
+            var uploadId = localStorage.getItem(key);
+
+            function createSession() {
+                formData.append('name', file.name);
+                formData.append('size', file.size);
+                formData.append('type', file.type);
+                $.ajax({url: '/upload/sessions', type: 'POST', data: formData, processData: false,
+                    contentType: false, dataType: 'json'}).done(function(upload) {
+                    localStorage.setItem(key, upload.upload_id);
+                    upload.received = [];
+                    sendChunks(upload);
+                }).fail(uploadError);
+            }
+
+            function sendChunks(upload) {
+                var pending = [];
+                for (var i = 0; i < upload.chunk_count; i++) {
+                    if (upload.received.indexOf(i) === -1) {
+                        pending.push(i);
+                    }
+                }
+                var running = 0;
+                var failed = false;
+                var next = function() {
+                    if (failed) {
+                        return;
+                    }
+                    if (pending.length === 0) {
+                        if (running === 0) {
+                            finish(upload);
                         }
+                        return;
+                    }
+                    var index = pending.shift();
+                    running++;
+                    sendChunk(upload, index, 3).then(function() {
+                        running--;
+                        $('.droparea').text(file.name + ' (' + Math.floor(100 * (upload.chunk_count - pending.length - running) / upload.chunk_count) + '%)');
+                        next();
+                    }, function(xhr) {
+                        failed = true;
+                        uploadError(xhr);
                     });
+                };
+                for (var j = 0; j < 3; j++) {
+                    next();
                 }
+            }
 
+            function sendChunk(upload, index, attempts) {
+                var start = index * upload.chunk_size;
+                var blob = file.slice(start, Math.min(start + upload.chunk_size, file.size));
+                return blob.arrayBuffer().then(function(data) {
+                    return crypto.subtle.digest('SHA-1', data).then(function(digest) {
+                        var checksum = Array.prototype.map.call(new Uint8Array(digest), function(byte) {
+                            return ('0' + byte.toString(16)).slice(-2);
+                        }).join('');
+                        return $.ajax({url: '/upload/sessions/' + upload.upload_id + '/chunks/' + index, type: 'PUT',
+                            data: data, processData: false, contentType: 'application/octet-stream',
+                            headers: {'X-Chunk-SHA1': checksum}});
+                    });
+                }).catch(function(xhr) {
+                    if (attempts <= 1) {
+                        throw xhr;
+                    }
+                    return new Promise(function(resolve) { setTimeout(resolve, 1000); }).then(function() {
+                        return sendChunk(upload, index, attempts - 1);
+                    });
                 });
+            }
+
+            function finish(upload) {
+                $.ajax({url: '/upload/sessions/' + upload.upload_id + '/finish', type: 'POST'}).done(function() {
+                    localStorage.removeItem(key);
+                    uploadSuccess();
+                }).fail(function(xhr) {
+                    // the session is gone after finishing, also when the file was a duplicate
+                    localStorage.removeItem(key);
+                    uploadError(xhr);
+                });
+            }
+
+            if (uploadId) {
+                $.ajax({url: '/upload/sessions/' + uploadId, dataType: 'json'}).done(sendChunks).fail(createSession);
+            } else {
+                createSession();
+            }
+        }
 
         $('#filetype').children().first().prop({disabled: true, hidden: true});
         $('#subject').children().first().prop({disabled: true, hidden: true});
@@ -630,6 +718,25 @@ $(document).ready(()=>{
             return false;
             });
 
+        // show thumbnails instead of icons where a preview exists, a missing preview keeps the icon
+        $('[data-preview]').each(function() {
+            var cell = $(this);
+            var fileType = cell.attr('data-file-type');
+            if (fileType.split('/')[0] === 'image' || fileType === 'application/pdf') {
+                $('<img class="file-thumbnail" alt="">').on('load', function() {
+                    if (this.naturalWidth > 0) {
+                        cell.find('.fa_icon').replaceWith(this);
+                    }
+                }).attr('src', cell.attr('data-preview'));
+            } else if (fileType.split('/')[0] === 'text') {
+                cell.one('mouseenter', function() {
+                    $.get(cell.attr('data-preview'), function(snippet) {
+                        cell.attr('title', snippet);
+                    }, 'text');
+                });
+            }
+        });
+
         $('.upload-file').on('click', function() {
             $.createModal({
                 title: 'Upload',
@@ -0,0 +1,160 @@
+# File containing functions for streaming folders as ZIP archives
+#
+# Please always provide a function description
+
+import hashlib
+import os
+import tempfile
+import threading
+import zipfile
+
+from Markis import app
+from Markis.util.transfer import read_file
+
+# types that are compressed already, deflating them again only costs time
+COMPRESSED_TYPES = ('application/pdf', 'application/zip', 'application/x-rar-compressed', 'application/gzip',
+					'application/x-7z-compressed', 'application/vnd.openxmlformats-officedocument')
+COMPRESSED_MAJOR_TYPES = ('image/', 'video/', 'audio/')
+
+cache_lock = threading.Lock()
+
+
+class ZipStream(object):
+	"""Write-only, unseekable file that keeps what is written until it is taken out with read_written.
+	ZipFile writes to it as if it were a socket, so the archive never has to be complete in memory or on disk.
+	"""
+
+	def __init__(self):
+		self._written = []
+
+	def write(self, data):
+		self._written.append(bytes(data))
+		return len(data)
+
+	def flush(self):
+		pass
+
+	def read_written(self):
+		"""
+		takes out everything written since the last call
+		:return: bytes written
+		"""
+		data = b''.join(self._written)
+		self._written = []
+		return data
+
+
+def get_compress_type(mimetype):
+	"""
+	gets the compression to use for a file in an archive
+	:param mimetype: the content type of the file
+	:return: zipfile.ZIP_STORED for files that are compressed already, zipfile.ZIP_DEFLATED for others
+	"""
+	if mimetype.startswith(COMPRESSED_TYPES) or mimetype.startswith(COMPRESSED_MAJOR_TYPES):
+		return zipfile.ZIP_STORED
+	return zipfile.ZIP_DEFLATED
+
+
+def get_archive_key(entries):
+	"""
+	gets the key under which an archive is cached, which is the same for the same files in any order
+	:param entries: List of (file_hash, path, arcname, mimetype, date) Tuples
+	:return: String containing the key
+	"""
+	contents = sorted("%s %s" % (entry[0], entry[2]) for entry in entries)
+	return hashlib.sha1("\n".join(contents).encode('utf-8')).hexdigest()
+
+
+def generate_zip(entries):
+	"""
+	generates a ZIP archive of files, reading one chunk of a file at a time
+	:param entries: List of (file_hash, path, arcname, mimetype, date) Tuples
+	:return: Generator of byte strings
+	"""
+	stream = ZipStream()
+	with zipfile.ZipFile(stream, 'w') as archive:
+		for file_hash, path, arcname, mimetype, date in entries:
+			info = zipfile.ZipInfo(arcname, date.timetuple()[:6])
+			info.compress_type = get_compress_type(mimetype)
+			size = os.path.getsize(path)
+			with archive.open(info, 'w', force_zip64=size > zipfile.ZIP64_LIMIT) as archived_file:
+				for chunk in read_file(path, 0, size):
+					archived_file.write(chunk)
+					yield stream.read_written()
+			yield stream.read_written()
+	yield stream.read_written()
+
+
+def get_cached_archive(key):
+	"""
+	gets the path of a cached archive
+	:param key: the key of the archive, see get_archive_key
+	:return: String containing the absolute path of the archive, or None if it is not cached
+	"""
+	if not app.config['ARCHIVE_CACHE_SIZE']:
+		return None
+	path = os.path.join(get_cache_dir(), key + '.zip')
+	if not os.path.isfile(path):
+		return None
+	# the least recently used archives are evicted first
+	os.utime(path)
+	return path
+
+
+def generate_and_cache_zip(entries, key):
+	"""
+	generates a ZIP archive, storing a copy in the archive cache once it is complete
+	:param entries: List of (file_hash, path, arcname, mimetype, date) Tuples
+	:param key: the key of the archive, see get_archive_key
+	:return: Generator of byte strings
+	"""
+	if not app.config['ARCHIVE_CACHE_SIZE']:
+		yield from generate_zip(entries)
+		return
+
+	cache_dir = get_cache_dir()
+	os.makedirs(cache_dir, exist_ok=True)
+	fd, temp_path = tempfile.mkstemp(prefix='.', suffix='.zip', dir=cache_dir)
+	completed = False
+	try:
+		with os.fdopen(fd, 'wb') as cache_file:
+			for data in generate_zip(entries):
+				cache_file.write(data)
+				yield data
+		os.replace(temp_path, os.path.join(cache_dir, key + '.zip'))
+		completed = True
+		evict_archives()
+	finally:
+		# the download was interrupted, so the copy is incomplete
+		if not completed and os.path.exists(temp_path):
+			os.remove(temp_path)
+
+
+def evict_archives():
+	"""
+	removes the least recently used archives until the cache fits in ARCHIVE_CACHE_SIZE bytes
+	"""
+	with cache_lock:
+		archives = []
+		with os.scandir(get_cache_dir()) as entries:
+			for entry in entries:
+				if entry.is_file() and not entry.name.startswith('.'):
+					stat = entry.stat()
+					archives.append((stat.st_mtime, stat.st_size, entry.path))
+		total_size = sum(size for mtime, size, path in archives)
+		for mtime, size, path in sorted(archives):
+			if total_size <= app.config['ARCHIVE_CACHE_SIZE']:
+				break
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				pass
+			total_size -= size
+
+
+def get_cache_dir():
+	"""
+	gets the directory in which archives are cached
+	:return: String containing the absolute path of the archive cache
+	"""
+	return os.path.join(app.root_path, app.config['ARCHIVE_CACHE_DIR'])
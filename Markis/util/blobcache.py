@@ -0,0 +1,144 @@
+# File containing a node-local disk cache of stored files, for a filestore on a shared (network) disk
+#
+# Please always provide a function description
+
+import os
+import shutil
+import tempfile
+import threading
+
+from Markis import app
+from Markis.util import filestore
+
+
+class BlobCache(object):
+	"""Read-through cache of stored files on a local disk. Once the files in the cache take more than <max_size>
+	bytes, the least recently used ones are removed. The size and the order of use are read from the cache
+	folder itself (a hit touches the copy), so all processes sharing the folder keep to one budget together.
+	Stored files never change, so a cached copy is valid until the file is removed.
+	A copy may be evicted by another process right after get_path returns it, so open it right away and fall
+	back to the filestore if it is gone, see transfer.send_stored_file.
+	"""
+
+	def __init__(self, directory, max_size):
+		self.directory = directory
+		self.max_size = max_size
+		self.size = None  # bytes in the cache at the last eviction check
+		self.files = None  # files in the cache at the last eviction check
+		self.hits = 0
+		self.misses = 0
+		self.fills = 0
+		self.evictions = 0
+		self._lock = threading.Lock()
+		self._fill_locks = {}
+
+	@property
+	def enabled(self):
+		return bool(self.directory and self.max_size)
+
+	def get_path(self, file_hash, source_path):
+		"""Get the path of a local copy of a stored file, copying it to the cache first if needed
+		:param file_hash: the hash of the file
+		:param source_path: the path of the file in the filestore
+		:return: String containing the path to read the file from, the source path if the file cannot be cached
+		"""
+		if not self.enabled:
+			return source_path
+		path = os.path.join(self.directory, file_hash)
+		try:
+			# the modification time of a copy is its last use, which is the eviction order
+			os.utime(path)
+			with self._lock:
+				self.hits += 1
+			return path
+		except FileNotFoundError:
+			pass
+		with self._lock:
+			self.misses += 1
+			# a single thread copies a file, the others asking for it wait for that copy
+			fill_lock = self._fill_locks.setdefault(file_hash, threading.Lock())
+
+		with fill_lock:
+			try:
+				if not os.path.isfile(path):
+					if os.path.getsize(source_path) > self.max_size:
+						return source_path
+					self._fill(source_path, path)
+					with self._lock:
+						self.fills += 1
+					self._evict(keep=file_hash)
+			except OSError as e:
+				app.logger.warning("Caching %s failed: %s", file_hash, e)
+				return source_path
+			finally:
+				with self._lock:
+					self._fill_locks.pop(file_hash, None)
+		return path
+
+	def discard(self, file_hash):
+		"""Remove the cached copy of a file
+		:param file_hash: the hash of the file
+		"""
+		if not self.enabled or not filestore.is_file_hash(file_hash):
+			return
+		self._remove(file_hash)
+
+	def _fill(self, source_path, path):
+		os.makedirs(self.directory, exist_ok=True)
+		fd, temp_path = tempfile.mkstemp(prefix='.', dir=self.directory)
+		try:
+			with os.fdopen(fd, 'wb') as temp_file, open(source_path, 'rb') as source:
+				shutil.copyfileobj(source, temp_file, app.config['UPLOAD_CHUNK_SIZE'])
+			# readers never see a partial copy, and concurrent copies by other processes simply replace each other
+			os.replace(temp_path, path)
+		finally:
+			if os.path.exists(temp_path):
+				os.remove(temp_path)
+
+	def _evict(self, keep=None):
+		# the cache folder is shared, so its contents are the budget rather than what this process copied
+		cached = []
+		with os.scandir(self.directory) as entries:
+			for entry in entries:
+				if filestore.is_file_hash(entry.name):
+					try:
+						stat = entry.stat()
+					except FileNotFoundError:
+						continue
+					cached.append((stat.st_mtime, entry.name, stat.st_size))
+		size = sum(file_size for mtime, file_hash, file_size in cached)
+		files = len(cached)
+		evictions = 0
+		for mtime, file_hash, file_size in sorted(cached):
+			if size <= self.max_size:
+				break
+			if file_hash == keep:
+				continue
+			# a copy that is being sent stays readable through its open file
+			self._remove(file_hash)
+			size -= file_size
+			files -= 1
+			evictions += 1
+		with self._lock:
+			self.size = size
+			self.files = files
+			self.evictions += evictions
+
+	def _remove(self, file_hash):
+		try:
+			os.remove(os.path.join(self.directory, file_hash))
+		except FileNotFoundError:
+			pass
+
+	def stats(self):
+		"""
+		gets the counters of the cache, the size and files as of the last copy made by this process
+		:return: Dict of the size in bytes, number of files, hits, misses, hit ratio, fills and evictions of the cache
+		"""
+		requests = self.hits + self.misses
+		return {'enabled': self.enabled, 'size': self.size, 'files': self.files,
+				'hits': self.hits, 'misses': self.misses, 'hit_ratio': self.hits / requests if requests else None,
+				'fills': self.fills, 'evictions': self.evictions}
+
+
+blob_cache = BlobCache(app.config['BLOB_CACHE_DIR'], app.config['BLOB_CACHE_SIZE'])
@@ -0,0 +1,104 @@
+# Small in-process caches used to keep remote lookups (Crowd) off the request path
+#
+# Please always provide a function description
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+	"""A thread-safe, size bounded cache whose entries expire after a time-to-live.
+	The least recently used entry is evicted once the cache is full.
+	"""
+
+	def __init__(self, maxsize, ttl):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._entries)
+
+	def __repr__(self):
+		return "<TTLCache(maxsize=%s, ttl=%s)>" % (self.maxsize, self.ttl)
+
+	def get(self, key, default=None):
+		"""Get a value from the cache
+		Args:
+			key: The key to look up.
+			default: The value to return when the key is missing or expired.
+		Returns:
+			The cached value, or default on a miss
+		"""
+
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None or entry[0] < time.monotonic():
+				self.misses += 1
+				return default
+			self._entries.move_to_end(key)
+			self.hits += 1
+			return entry[1]
+
+	def get_stale(self, key, default=None):
+		"""Get a value from the cache, even if it has expired.
+		Expired entries are kept until they are evicted or invalidated, so they can be
+		served while the source of the data is unavailable.
+		Args:
+			key: The key to look up.
+			default: The value to return when the key is missing.
+		Returns:
+			The cached value, or default if the key is not in the cache
+		"""
+
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				return default
+			return entry[1]
+
+	def set(self, key, value, ttl=None):
+		"""Store a value in the cache, evicting the least recently used entry if the cache is full
+		Args:
+			key: The key to store the value under.
+			value: The value to store.
+			ttl: optional time-to-live of this entry in seconds (default: the ttl of the cache)
+		"""
+
+		if ttl is None:
+			ttl = self.ttl
+		with self._lock:
+			self._entries[key] = (time.monotonic() + ttl, value)
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.maxsize:
+				self._entries.popitem(last=False)
+
+	def invalidate(self, key):
+		"""Remove a key from the cache, if present
+		Args:
+			key: The key to remove.
+		"""
+
+		with self._lock:
+			self._entries.pop(key, None)
+
+	def clear(self):
+		"""Remove all entries from the cache"""
+
+		with self._lock:
+			self._entries.clear()
+
+	def stats(self):
+		"""Get the usage counters of the cache
+		Returns:
+			dict:
+				size, maxsize, ttl, hits and misses of the cache
+		"""
+
+		with self._lock:
+			return {'size': len(self._entries), 'maxsize': self.maxsize, 'ttl': self.ttl,
+					'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,98 @@
+# File containing functions for storing gzip compressed variants of stored files
+#
+# Please always provide a function description
+
+import gzip
+import os
+import shutil
+import tempfile
+
+from flask import request
+
+from Markis import app
+from Markis.util import filestore, jobs
+
+GZIP_SUFFIX = 'gz'
+# types that are sent as they are stored but shrink a lot when compressed
+COMPRESSIBLE_TYPES = ('application/json', 'application/xml', 'application/javascript', 'application/rtf',
+					'application/postscript', 'application/x-tex', 'application/x-latex', 'application/x-sh',
+					'application/msword', 'application/mspowerpoint', 'application/vnd.ms-powerpoint',
+					'application/excel', 'application/vnd.ms-excel', 'image/svg+xml', 'image/bmp')
+
+compression_queue = jobs.JobQueue('compression', app.config['GZIP_WORKERS'], app.config['GZIP_QUEUE_SIZE'])
+
+
+def is_compressible(mimetype):
+	"""
+	checks whether files of a type are worth compressing
+	:param mimetype: the content type of the file
+	:return: Boolean whether a gzip variant may be stored for the type
+	"""
+	if not mimetype:
+		return False
+	return mimetype.startswith('text/') or mimetype.split(';')[0] in COMPRESSIBLE_TYPES
+
+
+def queue_compression(file_hash, mimetype):
+	"""
+	queues a stored file to store a gzip variant of, when the queue is full the file is sent as it is
+	until `flask compress-files` is run
+	:param file_hash: the hash of the file
+	:param mimetype: the content type of the file
+	:return: Boolean whether the file was queued
+	"""
+	if not is_compressible(mimetype):
+		return False
+	return compression_queue.put(compress_file, file_hash, get_compression_options())
+
+
+def get_compression_options():
+	"""
+	gets the settings compress_file is queued with
+	:return: Dict of the compression settings
+	"""
+	return {'min_size': app.config['GZIP_MIN_SIZE'], 'min_saving': app.config['GZIP_MIN_SAVING'],
+			'level': app.config['GZIP_LEVEL'], 'chunk_size': app.config['UPLOAD_CHUNK_SIZE']}
+
+
+def compress_file(file_hash, options):
+	"""
+	stores a gzip variant of a stored file next to it, if that saves enough bytes. Runs in a worker process.
+	:param file_hash: the hash of the file
+	:param options: Dict of settings, see get_compression_options
+	:return: String containing the path of the variant, or None if it was not stored
+	"""
+	path = filestore.find_file(file_hash)
+	if path is None:
+		return None
+	size = os.path.getsize(path)
+	if size < options['min_size']:
+		return None
+	gzip_path = filestore.get_variant_path(file_hash, GZIP_SUFFIX)
+	os.makedirs(os.path.dirname(gzip_path), exist_ok=True)
+	fd, temp_path = tempfile.mkstemp(prefix=filestore.TEMP_PREFIX, dir=os.path.dirname(gzip_path))
+	try:
+		# no name and mtime in the header, so the variant of a file is always the same
+		with open(path, 'rb') as file, os.fdopen(fd, 'wb') as temp_file, \
+				gzip.GzipFile('', 'wb', options['level'], temp_file, mtime=0) as gzip_file:
+			shutil.copyfileobj(file, gzip_file, options['chunk_size'])
+		if size - os.path.getsize(temp_path) < size * options['min_saving']:
+			return None
+		os.replace(temp_path, gzip_path)
+		return gzip_path
+	finally:
+		if os.path.exists(temp_path):
+			os.remove(temp_path)
+
+
+def find_gzip_variant(file_hash):
+	"""
+	finds the gzip variant of a stored file, if the client accepts it
+	:param file_hash: the hash of the file
+	:return: String containing the path of the variant, or None if the file should be sent as it is stored
+	"""
+	# the proxy does not pass on our Content-Encoding when it sends a file itself
+	if app.config['FILESTORE_OFFLOAD'] or not request.accept_encodings['gzip']:
+		return None
+	gzip_path = filestore.get_variant_path(file_hash, GZIP_SUFFIX)
+	return gzip_path if os.path.isfile(gzip_path) else None
@@ -3,19 +3,120 @@
 # This file is an adaptation of his python-crowd library
 
 import json
+import random
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
 
+class CrowdUnavailableError(Exception):
+	"""Raised when the Crowd server cannot be reached, or when the circuit breaker is open"""
+	pass
+
+
+class CircuitBreaker(object):
+	"""Stops sending requests to the Crowd server after consecutive failures.
+	The breaker opens after <failure_threshold> consecutive failures and lets a
+	single trial request through once <reset_timeout> seconds have passed.
+	A successful trial closes it again, a failed one re-opens it.
+	"""
+
+	CLOSED = 'closed'
+	OPEN = 'open'
+	HALF_OPEN = 'half-open'
+
+	def __init__(self, failure_threshold=5, reset_timeout=30):
+		self.failure_threshold = failure_threshold
+		self.reset_timeout = reset_timeout
+		self.state = self.CLOSED
+		self.consecutive_failures = 0
+		self.opened_at = None
+		self.requests = 0
+		self.failures = 0
+		self.rejected = 0
+		self.last_latency = None
+		self.average_latency = None
+		self._lock = threading.Lock()
+
+	def allow(self):
+		"""Check whether a request may be sent
+		Returns:
+			bool:
+				True if the request may be sent to the Crowd server
+		"""
+
+		with self._lock:
+			if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+				self.state = self.HALF_OPEN
+				return True
+			if self.state != self.CLOSED:
+				self.rejected += 1
+				return False
+			return True
+
+	def record_success(self, latency):
+		"""Register a successful request
+		Args:
+			latency: The duration of the request in seconds.
+		"""
+
+		with self._lock:
+			self.requests += 1
+			self.consecutive_failures = 0
+			self.state = self.CLOSED
+			self.last_latency = latency
+			if self.average_latency is None:
+				self.average_latency = latency
+			else:
+				# exponentially weighted, so the average follows degradation quickly
+				self.average_latency = 0.8 * self.average_latency + 0.2 * latency
+
+	def record_failure(self):
+		"""Register a failed request, opening the breaker if needed"""
+
+		with self._lock:
+			self.requests += 1
+			self.failures += 1
+			self.consecutive_failures += 1
+			if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+				self.state = self.OPEN
+				self.opened_at = time.monotonic()
+
+	def stats(self):
+		"""Get the state and counters of the breaker
+		Returns:
+			dict:
+				state, failure counters and latencies (in milliseconds) of the breaker
+		"""
+
+		with self._lock:
+			return {
+				'state': self.state,
+				'consecutive_failures': self.consecutive_failures,
+				'requests': self.requests,
+				'failures': self.failures,
+				'rejected': self.rejected,
+				'last_latency_ms': None if self.last_latency is None else round(self.last_latency * 1000, 1),
+				'average_latency_ms': None if self.average_latency is None else round(self.average_latency * 1000, 1)
+			}
+
+
 class Crowd(object):
 
-	def __init__(self, crowd_url, app_name, app_pass, timeout=None):
+	def __init__(self, crowd_url, app_name, app_pass, timeout=(3.05, 10), pool_size=10, retries=2, backoff=0.1,
+				breaker=None):
 		self.crowd_url = crowd_url
 		self.app_name = app_name
 		self.app_pass = app_pass
 		self.rest_url = crowd_url.rstrip("/") + "/rest/usermanagement/latest"
+		self.pool_size = pool_size
 		self.session = self._build_session()
 		self.timeout = timeout
+		self.retries = retries
+		self.backoff = backoff
+		self.breaker = breaker or CircuitBreaker()
 
 	def __str__(self):
 		return "Crowd Server at %s as service %s" % self.crowd_url % self.app_name
@@ -32,8 +133,48 @@ class Crowd(object):
 		session = requests.Session()
 		session.auth = requests.auth.HTTPBasicAuth(self.app_name, self.app_pass)
 		session.headers.update(headers)
+		# one pooled connection per worker thread, retries are handled by _request
+		adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=0)
+		session.mount('http://', adapter)
+		session.mount('https://', adapter)
 		return session
 
+	def _request(self, method, *args, **kwargs):
+		"""Send a request through the circuit breaker, retrying idempotent (GET) requests with jittered back-off
+		Args:
+			method: The HTTP method of the request.
+		Returns:
+			Response:
+				A Requests Response object
+		Raises:
+			CrowdUnavailableError: If the breaker is open, or the Crowd server could not be reached or failed
+		"""
+
+		if 'timeout' not in kwargs:
+			kwargs['timeout'] = self.timeout
+
+		if not self.breaker.allow():
+			raise CrowdUnavailableError("Circuit breaker for %s is open" % self.crowd_url)
+
+		attempts = self.retries + 1 if method == 'GET' else 1
+		for attempt in range(attempts):
+			if attempt > 0:
+				time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+			start = time.monotonic()
+			try:
+				response = self.session.request(method, *args, **kwargs)
+			except (requests.ConnectionError, requests.Timeout) as e:
+				error = e
+				continue
+			if response.status_code >= 500:
+				error = "Crowd server responded with status %s" % response.status_code
+				continue
+			self.breaker.record_success(time.monotonic() - start)
+			return response
+
+		self.breaker.record_failure()
+		raise CrowdUnavailableError(error)
+
 	def _get(self, *args, **kwargs):
 		"""Wrapper around Requests for GET requests
 				Returns:
@@ -41,11 +182,7 @@ class Crowd(object):
 						A Requests Response object
 				"""
 
-		if 'timeout' not in kwargs:
-			kwargs['timeout'] = self.timeout
-
-		req = self.session.get(*args, **kwargs)
-		return req
+		return self._request('GET', *args, **kwargs)
 
 	def _post(self, *args, **kwargs):
 		"""Wrapper around Requests for POST requests
@@ -54,11 +191,7 @@ class Crowd(object):
 				A Requests Response object
 		"""
 
-		if 'timeout' not in kwargs:
-			kwargs['timeout'] = self.timeout
-
-		req = self.session.post(*args, **kwargs)
-		return req
+		return self._request('POST', *args, **kwargs)
 
 	def _put(self, *args, **kwargs):
 		"""Wrapper around Requests for PUT requests
@@ -67,11 +200,7 @@ class Crowd(object):
 				A Requests Response object
 		"""
 
-		if 'timeout' not in kwargs:
-			kwargs['timeout'] = self.timeout
-
-		req = self.session.put(*args, **kwargs)
-		return req
+		return self._request('PUT', *args, **kwargs)
 
 	def _delete(self, *args, **kwargs):
 		"""Wrapper around Requests for DELETE requests
@@ -80,11 +209,18 @@ class Crowd(object):
 				A Requests Response object
 		"""
 
-		if 'timeout' not in kwargs:
-			kwargs['timeout'] = self.timeout
+		return self._request('DELETE', *args, **kwargs)
+
+	def stats(self):
+		"""Get the health of the connection to the Crowd server
+		Returns:
+			dict:
+				Circuit breaker state, request counters and latencies
+		"""
 
-		req = self.session.delete(*args, **kwargs)
-		return req
+		stats = self.breaker.stats()
+		stats['url'] = self.crowd_url
+		return stats
 
 	def auth_ping(self):
 		"""Test that application can authenticate to Crowd.
@@ -200,7 +336,7 @@ class Crowd(object):
 		}
 
 		if proxy:
-			params["validation-factors"]["validationFactors"].append({"name": "X-Forwarded-For", "value": proxy})
+			params["validationFactors"].append({"name": "X-Forwarded-For", "value": proxy})
 
 		url = self.rest_url + "/session/%s" % token
 		response = self._post(url, data=json.dumps(params), params={"expand": "user"})
@@ -0,0 +1,266 @@
+# Asyncio version of the Crowd REST client, so independent lookups can run at the same time
+#
+# Please always provide a function description
+
+import asyncio
+import json
+import random
+import threading
+import time
+import aiohttp
+
+from .crowd import CircuitBreaker, CrowdUnavailableError
+
+
+class AsyncCrowd(object):
+	"""Asyncio counterpart of Crowd, offering the same lookup and authentication methods as coroutines.
+	Requests go through the same timeouts, retries and circuit breaker as the synchronous client.
+	"""
+
+	def __init__(self, crowd_url, app_name, app_pass, timeout=(3.05, 10), pool_size=10, retries=2, backoff=0.1,
+				breaker=None):
+		self.crowd_url = crowd_url
+		self.app_name = app_name
+		self.app_pass = app_pass
+		self.rest_url = crowd_url.rstrip("/") + "/rest/usermanagement/latest"
+		self.timeout = timeout
+		self.pool_size = pool_size
+		self.retries = retries
+		self.backoff = backoff
+		self.breaker = breaker or CircuitBreaker()
+		self._session = None
+
+	def __repr__(self):
+		return "<AsyncCrowdServer('%s', '%s')>" % (self.crowd_url, self.app_name)
+
+	def _get_session(self):
+		"""Get the aiohttp session, creating it on first use so it belongs to the running event loop
+		Returns:
+			ClientSession:
+				An aiohttp ClientSession object
+		"""
+
+		if self._session is None:
+			self._session = aiohttp.ClientSession(
+				auth=aiohttp.BasicAuth(self.app_name, self.app_pass),
+				headers={'Content-Type': 'application/json', 'Accept': 'application/json'},
+				connector=aiohttp.TCPConnector(limit=self.pool_size),
+				timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]))
+		return self._session
+
+	async def close(self):
+		"""Close the aiohttp session and its pooled connections"""
+
+		if self._session is not None:
+			await self._session.close()
+			self._session = None
+
+	async def _request(self, method, url, params=None, data=None):
+		"""Send a request through the circuit breaker, retrying idempotent (GET) requests with jittered back-off
+		Args:
+			method: The HTTP method of the request.
+			url: The url to send the request to.
+			params: Query parameters of the request.
+			data: Body of the request.
+		Returns:
+			tuple:
+				The status code and the decoded JSON body (None if there is no body or on error)
+		Raises:
+			CrowdUnavailableError: If the breaker is open, or the Crowd server could not be reached or failed
+		"""
+
+		if not self.breaker.allow():
+			raise CrowdUnavailableError("Circuit breaker for %s is open" % self.crowd_url)
+
+		attempts = self.retries + 1 if method == 'GET' else 1
+		for attempt in range(attempts):
+			if attempt > 0:
+				await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+			start = time.monotonic()
+			try:
+				async with self._get_session().request(method, url, params=params, data=data) as response:
+					body = await response.read()
+					status = response.status
+			except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+				error = e
+				continue
+			if status >= 500:
+				error = "Crowd server responded with status %s" % status
+				continue
+			self.breaker.record_success(time.monotonic() - start)
+			# error bodies are not used and are not guaranteed to be JSON
+			return status, json.loads(body.decode('utf-8')) if body and status < 400 else None
+
+		self.breaker.record_failure()
+		raise CrowdUnavailableError(error)
+
+	async def auth_user(self, username, password):
+		"""Authenticate a user account against the Crowd server.
+		Returns:
+			dict: A dict mapping of user attributes if authentication was successful.
+			None: If authentication failed.
+		"""
+
+		status, body = await self._request('POST', self.rest_url + "/authentication",
+										params={"username": username},
+										data=json.dumps({"value": password}))
+
+		if status >= 400:
+			return None
+
+		return body
+
+	async def validate_session(self, token, remote="127.0.0.1", proxy=None):
+		"""Validate a session token.
+		Returns:
+			dict: A dict mapping of the session and its user if the token is valid.
+			None: If validation failed.
+		"""
+
+		params = {
+			"validationFactors": [
+				{"name": "remote_address", "value": remote, },
+			]
+		}
+
+		if proxy:
+			params["validationFactors"].append({"name": "X-Forwarded-For", "value": proxy})
+
+		status, body = await self._request('POST', self.rest_url + "/session/%s" % token,
+										params={"expand": "user"},
+										data=json.dumps(params))
+
+		if status >= 400:
+			return None
+
+		return body
+
+	async def get_user(self, username):
+		"""Retrieve information about a user
+		Returns:
+			dict: User information
+			None: If no user or failure occurred
+		"""
+
+		status, body = await self._request('GET', self.rest_url + "/user",
+										params={"username": username, "expand": "attributes"})
+
+		if status >= 400:
+			return None
+
+		return body
+
+	async def get_groups(self, username):
+		"""Retrieves a list of group names that have <username> as a direct member.
+		Returns:
+			list:
+				A list of strings of group names.
+		"""
+
+		status, body = await self._request('GET', self.rest_url + "/user/group/direct",
+										params={"username": username})
+
+		if status >= 400:
+			return None
+
+		return [g['name'] for g in body['groups']]
+
+	async def get_nested_groups(self, username):
+		"""Retrieve a list of all group names that have <username> as a direct or indirect member.
+		Returns:
+			list:
+				A list of strings of group names.
+		"""
+
+		status, body = await self._request('GET', self.rest_url + "/user/group/nested",
+										params={"username": username})
+
+		if status >= 400:
+			return None
+
+		return [g['name'] for g in body['groups']]
+
+	async def get_nested_group_users(self, groupname):
+		"""Retrieves a list of all users that directly or indirectly belong to the given groupname.
+		Returns:
+			list:
+				A list of strings of user names.
+		"""
+
+		status, body = await self._request('GET', self.rest_url + "/group/user/nested",
+										params={"groupname": groupname,
+												"start-index": 0,
+												"max-results": 99999})
+
+		if status >= 400:
+			return None
+
+		return [u['name'] for u in body['users']]
+
+	async def user_exists(self, username):
+		"""Determines if the user exists.
+		Returns:
+			bool:
+				True if the user exists in the Crowd application.
+		"""
+
+		status, body = await self._request('GET', self.rest_url + "/user", params={"username": username})
+
+		if status >= 400:
+			return None
+
+		return True
+
+	async def email_exists(self, email):
+		"""Determines if an email is already used.
+		Returns:
+			bool:
+				True if the email exists in the Crowd application.
+		"""
+
+		status, body = await self._request('GET', self.rest_url + "/user", params={"email": email})
+
+		if status >= 400:
+			return None
+
+		return True
+
+
+class ParallelCrowd(object):
+	"""Synchronous facade around AsyncCrowd for use in (threaded) Flask views.
+	Coroutines run on one background event loop shared by all threads, so
+	independent lookups are sent at the same time and wait only one round trip.
+	"""
+
+	def __init__(self, async_crowd):
+		self.crowd = async_crowd
+		self._loop = None
+		self._lock = threading.Lock()
+
+	def _get_loop(self):
+		"""Get the background event loop, starting its thread on first use
+		Returns:
+			AbstractEventLoop:
+				The running event loop
+		"""
+
+		with self._lock:
+			if self._loop is None:
+				self._loop = asyncio.new_event_loop()
+				thread = threading.Thread(target=self._loop.run_forever, name='crowd-event-loop', daemon=True)
+				thread.start()
+			return self._loop
+
+	def run(self, *coroutines):
+		"""Run coroutines concurrently and wait for all of them
+		Args:
+			*coroutines: The coroutines to run.
+		Returns:
+			list:
+				The results of the coroutines, in order
+		"""
+
+		async def gather():
+			return await asyncio.gather(*coroutines)
+
+		return asyncio.run_coroutine_threadsafe(gather(), self._get_loop()).result()
@@ -0,0 +1,317 @@
+# File containing functions for storing files in the filestore
+#
+# Please always provide a function description
+
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+
+from Markis import app
+
+TEMP_PREFIX = '.upload-'  # prefix of files that are still being received
+HASH_PATTERN = re.compile(r'^[0-9a-f]{40}$')
+PREFIX_PATTERN = re.compile(r'^[0-9a-f]{2}$')
+
+
+class PresenceIndex(object):
+	"""Set of the hashes of all stored files, so checking whether a file exists needs no filesystem access.
+	It is loaded by a background thread, started on first use if not started before, which then reconciles it
+	with the filestore every <interval> seconds. Until it is loaded, lookups go to disk. It is updated when
+	files are stored or removed. A hash that is not in the index is still looked up on disk, so files stored
+	by other nodes sharing the filestore are found as well.
+	"""
+
+	def __init__(self, interval):
+		self.interval = interval
+		self.hashes = None
+		self.hits = 0
+		self.misses = 0
+		self.found_on_disk = 0
+		self.scans = 0
+		self.last_scan = None
+		self.drift_added = 0
+		self.drift_removed = 0
+		self._changed = set()
+		self._lock = threading.Lock()
+		self._scan_lock = threading.Lock()  # one scan at a time, each scan tracks the changes made during it
+		self._thread = None
+
+	def __contains__(self, file_hash):
+		hashes = self.hashes
+		if hashes is None:
+			# scanning a large (network) filestore takes a while, meanwhile look on disk
+			self.start()
+			with self._lock:
+				self.misses += 1
+			return find_file(file_hash) is not None
+		if file_hash in hashes:
+			with self._lock:
+				self.hits += 1
+			return True
+		with self._lock:
+			self.misses += 1
+		if find_file(file_hash) is None:
+			return False
+		with self._lock:
+			self.found_on_disk += 1
+		self.add(file_hash)
+		return True
+
+	def add(self, file_hash):
+		"""Register a stored file
+		:param file_hash: the hash of the file
+		"""
+		with self._lock:
+			if self.hashes is not None:
+				self.hashes.add(file_hash)
+			self._changed.add(file_hash)
+
+	def discard(self, file_hash):
+		"""Register a removed file
+		:param file_hash: the hash of the file
+		"""
+		with self._lock:
+			if self.hashes is not None:
+				self.hashes.discard(file_hash)
+			self._changed.add(file_hash)
+
+	def reconcile(self):
+		"""Scan the filestore and bring the index in line with it, counting the differences as drift.
+		Files stored or removed during the scan are left as they are in the index.
+		"""
+		with self._scan_lock:
+			with self._lock:
+				self._changed = set()
+			scanned = set(scan_file_hashes())
+			with self._lock:
+				if self.hashes is None:
+					self.hashes = scanned | {file_hash for file_hash in self._changed if find_file(file_hash)}
+				else:
+					added = scanned - self.hashes - self._changed
+					removed = self.hashes - scanned - self._changed
+					self.drift_added += len(added)
+					self.drift_removed += len(removed)
+					self.hashes |= added
+					self.hashes -= removed
+				self.scans += 1
+				self.last_scan = time.time()
+
+	def start(self):
+		"""Start loading and reconciling the index in a background thread, if not started yet"""
+		with self._lock:
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run, name='filestore-presence-index', daemon=True)
+				self._thread.start()
+
+	def _run(self):
+		while True:
+			self.reconcile()
+			time.sleep(self.interval)
+
+	def stats(self):
+		"""
+		gets the counters of the index
+		:return: Dict of the size, hits, misses, files found on disk after a miss, scans and drift of the index
+		"""
+		return {'size': None if self.hashes is None else len(self.hashes), 'hits': self.hits, 'misses': self.misses,
+				'found_on_disk': self.found_on_disk, 'scans': self.scans, 'last_scan': self.last_scan,
+				'drift_added': self.drift_added, 'drift_removed': self.drift_removed}
+
+
+presence_index = PresenceIndex(app.config['FILESTORE_SCAN_INTERVAL'])
+
+
+def get_filestore_dir():
+	"""
+	gets the directory in which all files are stored
+	:return: String containing the absolute path of the filestore
+	"""
+	return os.path.join(app.root_path, app.config['FILESTORE_DIR'])
+
+
+def is_file_hash(file_hash):
+	"""
+	checks whether a string is a valid (lower case) SHA-1 hash, and thus safe to use in a path
+	:param file_hash: the string to check
+	:return: Boolean whether it is a valid hash
+	"""
+	return HASH_PATTERN.match(file_hash) is not None
+
+
+def get_file_path(file_hash):
+	"""
+	gets the path at which a file is stored, fanned out over sub-folders by hash prefix (ab/cd/abcd...)
+	:param file_hash: the hash of the file
+	:return: String containing the absolute path of the file
+	"""
+	prefixes = [file_hash[2 * level:2 * level + 2] for level in range(app.config['FILESTORE_FANOUT'])]
+	return os.path.join(get_filestore_dir(), *prefixes, file_hash)
+
+
+def get_variant_path(file_hash, suffix):
+	"""
+	gets the path at which a file derived from a stored file (e.g. a preview) is kept, next to the file itself
+	:param file_hash: the hash of the stored file
+	:param suffix: the name of the variant, e.g. preview.png
+	:return: String containing the absolute path of the variant
+	"""
+	return get_file_path(file_hash) + '.' + suffix
+
+
+def get_legacy_file_path(file_hash):
+	"""
+	gets the path at which a file was stored before the filestore was fanned out
+	:param file_hash: the hash of the file
+	:return: String containing the absolute path of the file in the flat layout
+	"""
+	return os.path.join(get_filestore_dir(), file_hash)
+
+
+def find_file(file_hash):
+	"""
+	finds a stored file, also looking in the flat layout for files that were not migrated yet
+	:param file_hash: the hash of the file
+	:return: String containing the absolute path of the file, or None if it is not stored
+	"""
+	if not is_file_hash(file_hash):
+		return None
+	file_path = get_file_path(file_hash)
+	legacy_file_path = get_legacy_file_path(file_hash)
+	# look in the new location again, in case the file was migrated while we were looking
+	for path in (file_path, legacy_file_path, file_path):
+		if os.path.isfile(path):
+			return path
+	return None
+
+
+def receive_file(stream):
+	"""
+	streams a file into a uniquely named temporary file in the filestore, hashing it on the way
+	:param stream: file-like object to read the file from
+	:return: Tuple of the SHA-1 hash of the file and the path of the temporary file
+	"""
+	filestore_dir = get_filestore_dir()
+	os.makedirs(filestore_dir, exist_ok=True)
+	sha1 = hashlib.sha1()
+	fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=filestore_dir)
+	try:
+		with os.fdopen(fd, 'wb') as temp_file:
+			for chunk in iter(lambda: stream.read(app.config['UPLOAD_CHUNK_SIZE']), b''):
+				sha1.update(chunk)
+				temp_file.write(chunk)
+	except BaseException:
+		os.remove(temp_path)
+		raise
+	return sha1.hexdigest(), temp_path
+
+
+def store_file(temp_path, file_hash):
+	"""
+	atomically moves a received file to its place in the filestore
+	:param temp_path: the path of the temporary file, as returned by receive_file
+	:param file_hash: the hash of the file
+	:return: String containing the path of the stored file
+	"""
+	file_path = get_file_path(file_hash)
+	os.makedirs(os.path.dirname(file_path), exist_ok=True)
+	os.replace(temp_path, file_path)
+	presence_index.add(file_hash)
+	return file_path
+
+
+def remove_file(file_hash):
+	"""
+	removes a file from the filestore
+	:param file_hash: the hash of the file to remove
+	:return: Boolean whether a file was removed
+	"""
+	presence_index.discard(file_hash)
+	remove_variants(file_hash)
+	file_path = find_file(file_hash)
+	if file_path is None:
+		return False
+	os.remove(file_path)
+	return True
+
+
+def remove_variants(file_hash):
+	"""
+	removes all files derived from a stored file, see get_variant_path
+	:param file_hash: the hash of the stored file
+	"""
+	if not is_file_hash(file_hash):
+		return
+	file_path = get_file_path(file_hash)
+	try:
+		with os.scandir(os.path.dirname(file_path)) as entries:
+			variants = [entry.path for entry in entries if entry.name.startswith(file_hash + '.')]
+	except FileNotFoundError:
+		return
+	for path in variants:
+		try:
+			os.remove(path)
+		except FileNotFoundError:
+			pass
+
+
+def walk_files():
+	"""
+	lists all files in the filestore, in both the flat and the fanned out layout: stored files, their
+	variants and whatever else ended up there
+	:return: Generator of Tuples of the name and the absolute path of a file
+	"""
+	for root, dirs, files in os.walk(get_filestore_dir()):
+		# only descend into hash prefix folders
+		dirs[:] = [name for name in dirs if PREFIX_PATTERN.match(name)]
+		for name in files:
+			yield name, os.path.join(root, name)
+
+
+def scan_file_hashes():
+	"""
+	lists the hashes of all stored files, in both the flat and the fanned out layout
+	:return: Generator of Strings containing file hashes
+	"""
+	for name, path in walk_files():
+		if is_file_hash(name):
+			yield name
+
+
+def discard_file(temp_path):
+	"""
+	removes a received file that will not be stored
+	:param temp_path: the path of the temporary file, as returned by receive_file
+	"""
+	try:
+		os.remove(temp_path)
+	except FileNotFoundError:
+		pass
+
+
+def migrate_layout(batch_size=100, pause=1.0, log=print):
+	"""
+	moves files from the flat layout to the fanned out layout, in batches so the site can stay online.
+	Every move is atomic and the flat layout only contains files that were not migrated yet,
+	so an interrupted migration can simply be started again.
+	:param batch_size: number of files to move before pausing
+	:param pause: seconds to pause between batches
+	:param log: function to report progress with
+	:return: Integer number of files moved
+	"""
+	moved = 0
+	with os.scandir(get_filestore_dir()) as entries:
+		for entry in entries:
+			if not entry.is_file() or not is_file_hash(entry.name):
+				continue
+			file_path = get_file_path(entry.name)
+			os.makedirs(os.path.dirname(file_path), exist_ok=True)
+			os.replace(entry.path, file_path)
+			moved += 1
+			if moved % batch_size == 0:
+				log("moved %d files" % moved)
+				time.sleep(pause)
+	log("moved %d files, migration complete" % moved)
+	return moved
@@ -0,0 +1,175 @@
+# File containing functions for keeping the folders table in line with the files table
+#
+# Please always provide a function description
+
+import posixpath
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import func
+
+from Markis.models import db, File, Folder
+
+LIKE_ESCAPE = '!'  # escape character of the LIKE patterns of get_below_pattern, the same on every database
+
+
+def get_folder_paths(display_path):
+	"""
+	gets the paths of a folder and all folders above it
+	:param display_path: the display path of the folder, e.g. exams/2016-2017/answers
+	:return: List of Strings containing the paths, e.g. exams, exams/2016-2017 and exams/2016-2017/answers
+	"""
+	parts = display_path.strip('/').split('/')
+	return ['/'.join(parts[:depth]) for depth in range(1, len(parts) + 1)]
+
+
+def get_parent(path):
+	"""
+	gets the path of the folder a folder is in
+	:param path: the path of the folder
+	:return: String containing the path of the parent, '' for the subject subfolders
+	"""
+	return posixpath.dirname(path)
+
+
+def get_below_pattern(path):
+	"""
+	gets the LIKE pattern of all paths below a folder, use it with escape=LIKE_ESCAPE
+	:param path: the display path of the folder
+	:return: String containing the pattern, with the % and _ in folder names escaped
+	"""
+	for character in (LIKE_ESCAPE, '%', '_'):
+		path = path.replace(character, LIKE_ESCAPE + character)
+	return path + '/%'
+
+
+def create_folders(subject_id, display_path):
+	"""
+	adds the rows of a folder and the folders above it that do not exist yet, in a transaction of its own
+	:param subject_id: the subject of the folder
+	:param display_path: the display path of the folder
+	"""
+	paths = get_folder_paths(display_path)
+	existing = {path for path, in db.session.query(Folder.path).filter(Folder.subject_id == subject_id,
+																	Folder.path.in_(paths))}
+	for path in paths:
+		if path in existing:
+			continue
+		db.session.add(Folder(subject_id=subject_id, path=path, parent=get_parent(path), file_count=0, total_bytes=0))
+		try:
+			db.session.commit()
+		except IntegrityError:
+			# created by an upload to the same folder at the same time
+			db.session.rollback()
+
+
+def add_file(subject_id, display_path, size):
+	"""
+	counts a file in its folder and the folders above it, as part of the transaction adding the file.
+	The folders have to exist, see create_folders. The counts are changed relative to their current
+	value, so uploads to the same folder at the same time are all counted.
+	:param subject_id: the subject of the file
+	:param display_path: the display path of the file
+	:param size: the size of the file in bytes
+	"""
+	Folder.query.filter(Folder.subject_id == subject_id, Folder.path.in_(get_folder_paths(display_path))).update({
+		Folder.file_count: Folder.file_count + 1,
+		Folder.total_bytes: Folder.total_bytes + (size or 0),
+		Folder.last_upload: func.now()
+	}, synchronize_session=False)
+
+
+def remove_file(subject_id, display_path, size):
+	"""
+	stops counting a file in its folder and the folders above it, as part of the transaction removing the file
+	:param subject_id: the subject of the file
+	:param display_path: the display path of the file
+	:param size: the size of the file in bytes
+	"""
+	Folder.query.filter(Folder.subject_id == subject_id, Folder.path.in_(get_folder_paths(display_path))).update({
+		Folder.file_count: Folder.file_count - 1,
+		Folder.total_bytes: Folder.total_bytes - (size or 0)
+	}, synchronize_session=False)
+
+
+def add_size(subject_id, display_path, size):
+	"""
+	counts the size of a file that was counted without it in its folder and the folders above it, as part of
+	the transaction storing the size. For files from before sizes were recorded, see the backfill-metadata command.
+	:param subject_id: the subject of the file
+	:param display_path: the display path of the file
+	:param size: the size of the file in bytes
+	"""
+	Folder.query.filter(Folder.subject_id == subject_id, Folder.path.in_(get_folder_paths(display_path))).update({
+		Folder.total_bytes: Folder.total_bytes + size
+	}, synchronize_session=False)
+
+
+def rebuild():
+	"""
+	recomputes the folders table from the files table
+	:return: Integer number of folders
+	"""
+	folders = {}
+	totals = db.session.query(File.subject_id, File.display_path, func.count(File.file_id),
+							func.coalesce(func.sum(File.size), 0), func.max(File.upload_date))\
+		.group_by(File.subject_id, File.display_path)
+	for subject_id, display_path, file_count, total_bytes, last_upload in totals:
+		for path in get_folder_paths(display_path):
+			folder = folders.setdefault((subject_id, path), {'subject_id': subject_id, 'path': path,
+															'parent': get_parent(path), 'file_count': 0,
+															'total_bytes': 0, 'last_upload': None})
+			folder['file_count'] += file_count
+			folder['total_bytes'] += int(total_bytes)
+			if folder['last_upload'] is None or last_upload > folder['last_upload']:
+				folder['last_upload'] = last_upload
+	Folder.query.delete()
+	if folders:
+		db.session.execute(Folder.__table__.insert(), list(folders.values()))
+	db.session.commit()
+	return len(folders)
+
+
+def get_folder(subject_id, path):
+	"""
+	gets a folder
+	:param subject_id: the subject of the folder
+	:param path: the display path of the folder
+	:return: Folder, or None if no file was ever uploaded to it
+	"""
+	return Folder.query.get((subject_id, path))
+
+
+def get_subfolders(subject_id, path):
+	"""
+	gets the folders in a folder, using the (subject_id, parent) index
+	:param subject_id: the subject of the folder
+	:param path: the display path of the folder, '' for the subject itself
+	:return: Dict of folder name: Folder
+	"""
+	return {posixpath.basename(folder.path): folder
+			for folder in Folder.query.filter(Folder.subject_id == subject_id, Folder.parent == path)}
+
+
+def get_year_periods(subject_id, category):
+	"""
+	gets the year periods of exams or homework of a subject in one lookup on the folder paths, so the work
+	does not grow with the number of files
+	:param subject_id: the subject of the folders
+	:param category: the subject subfolder holding year periods, exams or homework
+	:return: List of Dicts with the name, file_count, total_bytes and last_upload of the year periods that
+	have files, and whether they have questions and answers, newest period first
+	"""
+	periods = {}
+	types = set()
+	for folder in Folder.query.filter(Folder.subject_id == subject_id, Folder.file_count > 0,
+									Folder.path.like(get_below_pattern(category), escape=LIKE_ESCAPE)):
+		parts = folder.path.split('/')
+		if len(parts) == 2:
+			periods[parts[1]] = {'name': parts[1], 'file_count': folder.file_count, 'total_bytes': folder.total_bytes,
+								'last_upload': folder.last_upload}
+		elif len(parts) == 3:
+			types.add((parts[1], parts[2]))
+	for name, period in periods.items():
+		period['questions'] = (name, 'questions') in types
+		period['answers'] = (name, 'answers') in types
+	return sorted(periods.values(), key=lambda period: period['name'], reverse=True)
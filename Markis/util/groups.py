@@ -0,0 +1,78 @@
+# In-process snapshots of crowd group memberships
+#
+# Please always provide a function description
+
+import threading
+import time
+
+from .crowd import CrowdUnavailableError
+
+
+class GroupSnapshot(object):
+	"""Set of all users that directly or indirectly belong to a crowd group.
+	The members are loaded and refreshed every <interval> seconds by a background
+	thread, so membership checks never wait on crowd. Until the first load succeeds
+	(version 0) nobody is a member. Every successful refresh increments <version>;
+	on failure the previous members are kept.
+	"""
+
+	def __init__(self, crowd_server, groupname, interval):
+		self.crowd_server = crowd_server
+		self.groupname = groupname
+		self.interval = interval
+		self.members = frozenset()
+		self.version = 0
+		self.refreshed_at = None
+		self.failures = 0
+		self._lock = threading.Lock()
+		self._thread = None
+
+	def __contains__(self, username):
+		return username in self.members
+
+	def __repr__(self):
+		return "<GroupSnapshot('%s', version=%s)>" % (self.groupname, self.version)
+
+	def refresh(self):
+		"""Load the members of the group from crowd
+		Returns:
+			True: The members were refreshed
+			False: Crowd could not be reached, the previous members are kept
+		"""
+
+		try:
+			members = self.crowd_server.get_nested_group_users(self.groupname)
+		except CrowdUnavailableError:
+			members = None
+		with self._lock:
+			if members is None:
+				self.failures += 1
+				return False
+			self.members = frozenset(members)
+			self.version += 1
+			self.refreshed_at = time.time()
+			return True
+
+	def start(self):
+		"""Start refreshing the members in a background thread, if not started yet"""
+
+		with self._lock:
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run, name='group-snapshot-%s' % self.groupname,
+												daemon=True)
+				self._thread.start()
+
+	def _run(self):
+		while True:
+			self.refresh()
+			time.sleep(self.interval)
+
+	def stats(self):
+		"""Get the state of the snapshot
+		Returns:
+			dict:
+				group name, number of members, version, time of the last refresh and failed refreshes
+		"""
+
+		return {'group': self.groupname, 'members': len(self.members), 'version': self.version,
+				'refreshed_at': self.refreshed_at, 'failures': self.failures}
@@ -0,0 +1,84 @@
+# File containing a queue for running background jobs in other processes
+#
+# Please always provide a function description
+
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from Markis import app
+
+
+class JobQueue(object):
+	"""Queue of jobs that are worked off by a bounded pool of processes, so they never slow down a request.
+	The queue is bounded as well; when it is full a job is dropped, a maintenance command has to do it later.
+	Jobs are module level functions (they are pickled to the processes) returning None if there was nothing to do.
+	The processes are forked from the app, so a job sees the config of the app as loaded when the pool started,
+	such as the filestore location; the settings of the job itself are read when it is queued and passed along.
+	"""
+
+	def __init__(self, name, workers, size):
+		self.name = name
+		self.workers = workers
+		self.done = 0
+		self.skipped = 0
+		self.failed = 0
+		self.dropped = 0
+		self._jobs = queue.Queue(size)
+		self._slots = threading.Semaphore(workers)
+		self._pool = None
+		self._thread = None
+		self._lock = threading.Lock()
+
+	def put(self, function, *args):
+		"""Queue a job
+		:param function: the function to run
+		:param args: the arguments to run it with
+		:return: Boolean whether the job was queued
+		"""
+		self.start()
+		try:
+			self._jobs.put_nowait((function, args))
+		except queue.Full:
+			self.dropped += 1
+			return False
+		return True
+
+	def start(self):
+		"""Start the pool and the thread feeding it, if not started yet"""
+		with self._lock:
+			if self._thread is None:
+				self._pool = ProcessPoolExecutor(max_workers=self.workers)
+				self._thread = threading.Thread(target=self._run, name=self.name + '-queue', daemon=True)
+				self._thread.start()
+
+	def _run(self):
+		while True:
+			function, args = self._jobs.get()
+			# only hand out as many jobs as there are workers, the rest waits in the bounded queue
+			self._slots.acquire()
+			try:
+				future = self._pool.submit(function, *args)
+			except Exception:
+				self._slots.release()
+				self.failed += 1
+				continue
+			future.add_done_callback(self._done)
+
+	def _done(self, future):
+		self._slots.release()
+		if future.exception() is not None:
+			self.failed += 1
+			app.logger.warning("A %s job failed: %s", self.name, future.exception())
+		elif future.result() is None:
+			self.skipped += 1
+		else:
+			self.done += 1
+
+	def stats(self):
+		"""
+		gets the counters of the queue
+		:return: Dict of the queued, done, skipped (nothing to do), failed and dropped jobs
+		"""
+		return {'queued': self._jobs.qsize(), 'done': self.done, 'skipped': self.skipped, 'failed': self.failed,
+				'dropped': self.dropped}
@@ -0,0 +1,87 @@
+# File containing functions for reading metadata (size, pages, dimensions) of stored files
+#
+# Please always provide a function description
+
+import os
+import re
+import struct
+
+SCAN_CHUNK_SIZE = 1024 * 1024  # bytes of a PDF scanned at a time when counting pages
+PDF_PAGE_PATTERN = re.compile(rb'/Type\s*/Page(?![a-zA-Z])')
+
+
+def read_metadata(path, mimetype):
+	"""
+	reads the metadata of a file that is cheap to get: its size, the page count of PDFs and the dimensions of images
+	:param path: the absolute path of the file on disk
+	:param mimetype: the content type of the file
+	:return: Dict with size, page_count, width and height (None where not applicable or unknown)
+	"""
+	metadata = {'size': os.path.getsize(path), 'page_count': None, 'width': None, 'height': None}
+	try:
+		if mimetype == 'application/pdf':
+			metadata['page_count'] = count_pdf_pages(path)
+		elif mimetype and mimetype.startswith('image/'):
+			dimensions = read_image_dimensions(path)
+			if dimensions:
+				metadata['width'], metadata['height'] = dimensions
+	except (OSError, struct.error):
+		# metadata is nice to have, a file we cannot parse is still a valid upload
+		pass
+	return metadata
+
+
+def count_pdf_pages(path):
+	"""
+	counts the pages of a PDF by its page objects, without rendering it.
+	PDFs that keep their page objects in compressed object streams cannot be counted this way.
+	:param path: the absolute path of the file on disk
+	:return: Integer number of pages, or None if no pages could be found
+	"""
+	pages = 0
+	tail = b''
+	with open(path, 'rb') as file:
+		for chunk in iter(lambda: file.read(SCAN_CHUNK_SIZE), b''):
+			data = tail + chunk
+			# matches starting in the last bytes are counted with the next chunk, they may continue in there
+			cut = max(len(data) - 32, 0)
+			pages += sum(1 for match in PDF_PAGE_PATTERN.finditer(data) if match.start() < cut)
+			tail = data[cut:]
+	pages += len(PDF_PAGE_PATTERN.findall(tail))
+	return pages or None
+
+
+def read_image_dimensions(path):
+	"""
+	reads the dimensions of a PNG, GIF or JPEG image from its header
+	:param path: the absolute path of the file on disk
+	:return: Tuple of width and height in pixels, or None for other or broken images
+	"""
+	with open(path, 'rb') as file:
+		header = file.read(26)
+		if header.startswith(b'\x89PNG\r\n\x1a\n'):
+			return struct.unpack('>II', header[16:24])
+		if header[:6] in (b'GIF87a', b'GIF89a'):
+			return struct.unpack('<HH', header[6:10])
+		if header.startswith(b'\xff\xd8'):
+			file.seek(2)
+			return read_jpeg_dimensions(file)
+	return None
+
+
+def read_jpeg_dimensions(file):
+	"""
+	reads the dimensions of a JPEG image from its start of frame segment
+	:param file: the image file, positioned right after the start of image marker
+	:return: Tuple of width and height in pixels, or None if no start of frame was found
+	"""
+	while True:
+		marker = file.read(2)
+		if len(marker) < 2 or marker[0] != 0xff:
+			return None
+		length = struct.unpack('>H', file.read(2))[0]
+		# SOF0-SOF15, except DHT (c4), JPG (c8) and DAC (cc)
+		if 0xc0 <= marker[1] <= 0xcf and marker[1] not in (0xc4, 0xc8, 0xcc):
+			height, width = struct.unpack('>xHH', file.read(5))
+			return width, height
+		file.seek(length - 2, os.SEEK_CUR)
@@ -0,0 +1,124 @@
+# File containing the changes to the schema of databases created before the current models, applied in order
+#
+# db.create_all only creates missing tables, so columns and indexes added to existing tables are added here.
+# Every migration checks what is there already, so a database created by db.create_all from the current
+# models (in which all migrations are already done) is only marked as migrated.
+# Add new migrations at the end of MIGRATIONS with the next version number, never change or reorder old ones.
+#
+# Please always provide a function description
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+from sqlalchemy.schema import CreateColumn
+
+from Markis import app
+from Markis.models import db, File, Folder, Vote, Favorite, SchemaVersion
+from Markis.util import folders, util
+
+
+def add_missing_columns(model, names):
+	"""
+	adds columns of a model to its table if the table does not have them yet
+	:param model: the model of the table
+	:param names: the names of the columns to add
+	"""
+	table = model.__table__
+	existing = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+	for name in names:
+		if name in existing:
+			continue
+		column = CreateColumn(table.columns[name]).compile(dialect=db.engine.dialect)
+		try:
+			db.session.execute(text('ALTER TABLE %s ADD COLUMN %s' % (table.name, column)))
+			db.session.commit()
+		except (OperationalError, ProgrammingError):
+			# fine if another node starting at the same time added it first (duplicate column)
+			db.session.rollback()
+			if name not in {found['name'] for found in inspect(db.engine).get_columns(table.name)}:
+				raise
+
+
+def add_missing_indexes(model):
+	"""
+	adds the indexes of a model to its table if the table does not have them yet
+	:param model: the model of the table
+	"""
+	table = model.__table__
+	existing = {index['name'] for index in inspect(db.engine).get_indexes(table.name)}
+	for index in table.indexes:
+		if index.name in existing:
+			continue
+		try:
+			index.create(bind=db.engine)
+		except (OperationalError, ProgrammingError):
+			# fine if another node starting at the same time created it first (duplicate index)
+			if index.name not in {found['name'] for found in inspect(db.engine).get_indexes(table.name)}:
+				raise
+
+
+def add_file_metadata():
+	"""adds the size, page count and dimensions of files, fill them in with the backfill-metadata command"""
+	add_missing_columns(File, ['size', 'page_count', 'width', 'height'])
+
+
+def add_vote_totals():
+	"""adds the vote totals of files and computes them from the votes"""
+	add_missing_columns(File, ['score', 'upvotes', 'downvotes'])
+	last_file_id = db.session.query(db.func.max(File.file_id)).scalar()
+	if last_file_id is not None:
+		util.reconcile_file_scores(0, last_file_id)
+
+
+def fill_folders():
+	"""fills in the folders table (created by db.create_all) from the files"""
+	# files without a size yet count as 0 bytes, backfill-metadata adds their size to the folders when it stores it
+	if Folder.query.first() is None and File.query.first() is not None:
+		folders.rebuild()
+
+
+def add_lookup_indexes():
+	"""adds the indexes of the folder listing and of the votes and favorites of a file"""
+	for model in (File, Vote, Favorite):
+		add_missing_indexes(model)
+
+
+# version, migration
+MIGRATIONS = [
+	(1, add_file_metadata),
+	(2, add_vote_totals),
+	(3, fill_folders),
+	(4, add_lookup_indexes),
+]
+
+
+def get_version():
+	"""
+	gets the version of the schema of the database
+	:return: Integer version of the last applied migration, 0 if none was applied
+	"""
+	return db.session.query(db.func.max(SchemaVersion.version)).scalar() or 0
+
+
+def migrate(log=app.logger.info):
+	"""
+	applies the migrations that have not been applied to the database yet, in order.
+	The tables have to exist, see db.create_all.
+	:param log: function to report the applied migrations with
+	:return: List of the versions that were applied
+	"""
+	applied = []
+	current = get_version()
+	for version, migration in MIGRATIONS:
+		if version <= current:
+			continue
+		log("Migrating the database to version %d: %s" % (version, migration.__doc__))
+		migration()
+		db.session.add(SchemaVersion(version=version, description=migration.__doc__[:200]))
+		try:
+			db.session.commit()
+		except IntegrityError:
+			# applied by another node starting at the same time, every migration re-checks the schema so running
+			# one twice does no harm
+			db.session.rollback()
+		applied.append(version)
+	return applied
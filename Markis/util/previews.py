@@ -0,0 +1,182 @@
+# File containing functions for generating previews (thumbnails and text snippets) of stored files
+#
+# Please always provide a function description
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+from Markis import app
+from Markis.util import filestore, jobs
+
+try:
+	from PIL import Image
+except ImportError:
+	# without Pillow images get no thumbnail, they keep their icon
+	Image = None
+
+# variants a preview can be stored as, in order of preference, with their content type
+PREVIEW_VARIANTS = (('preview.png', 'image/png'), ('preview.txt', 'text/plain'))
+
+preview_queue = jobs.JobQueue('preview', app.config['PREVIEW_WORKERS'], app.config['PREVIEW_QUEUE_SIZE'])
+
+
+def queue_preview(file_hash, mimetype):
+	"""
+	queues a stored file to generate a preview for, when the queue is full the file keeps its icon
+	until `flask generate-previews` is run
+	:param file_hash: the hash of the file
+	:param mimetype: the content type of the file
+	:return: Boolean whether the file was queued
+	"""
+	if not can_preview(mimetype):
+		return False
+	return preview_queue.put(generate_preview, file_hash, mimetype, get_preview_options())
+
+
+def can_preview(mimetype):
+	"""
+	checks whether a preview can be generated for a type of file
+	:param mimetype: the content type of the file
+	:return: Boolean whether previews are generated for the type
+	"""
+	if not mimetype:
+		return False
+	return mimetype.startswith(('image/', 'text/')) or mimetype == 'application/pdf'
+
+
+def find_preview(file_hash):
+	"""
+	finds the preview of a stored file
+	:param file_hash: the hash of the file
+	:return: Tuple of the absolute path and content type of the preview, or None if there is no preview (yet)
+	"""
+	if not filestore.is_file_hash(file_hash):
+		return None
+	for suffix, mimetype in PREVIEW_VARIANTS:
+		path = filestore.get_variant_path(file_hash, suffix)
+		if os.path.isfile(path):
+			return path, mimetype
+	return None
+
+
+def get_preview_options():
+	"""
+	gets the settings generate_preview is queued with
+	:return: Dict of the preview settings
+	"""
+	return {'size': app.config['PREVIEW_SIZE'], 'text_bytes': app.config['PREVIEW_TEXT_BYTES'],
+			'text_lines': app.config['PREVIEW_TEXT_LINES'], 'timeout': app.config['PREVIEW_TIMEOUT']}
+
+
+def generate_preview(file_hash, mimetype, options):
+	"""
+	generates the preview of a stored file, runs in a worker process.
+	Images get a thumbnail, PDFs a render of their first page (or a snippet of its text) and text files a snippet.
+	:param file_hash: the hash of the file
+	:param mimetype: the content type of the file
+	:param options: Dict of settings, see get_preview_options
+	:return: String containing the path of the preview, or None if no preview could be generated
+	"""
+	path = filestore.find_file(file_hash)
+	if path is None:
+		return None
+	png_path = filestore.get_variant_path(file_hash, 'preview.png')
+	txt_path = filestore.get_variant_path(file_hash, 'preview.txt')
+	if mimetype.startswith('image/'):
+		if Image is None:
+			return None
+		return write_atomically(png_path, lambda temp_path: render_thumbnail(path, temp_path, options['size']))
+	if mimetype == 'application/pdf':
+		if shutil.which('pdftoppm'):
+			return write_atomically(png_path, lambda temp_path: render_pdf_page(path, temp_path, options))
+		if shutil.which('pdftotext'):
+			return write_atomically(txt_path, lambda temp_path: extract_pdf_text(path, temp_path, options))
+		return None
+	return write_atomically(txt_path, lambda temp_path: write_text_snippet(path, temp_path, options))
+
+
+def write_atomically(path, write):
+	"""
+	writes a preview to a temporary file first, so a half written preview is never served
+	:param path: the path of the preview
+	:param write: function writing the preview to the path it is given
+	:return: String containing the path of the preview
+	"""
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	fd, temp_path = tempfile.mkstemp(prefix=filestore.TEMP_PREFIX, dir=os.path.dirname(path))
+	os.close(fd)
+	try:
+		write(temp_path)
+		os.replace(temp_path, path)
+	finally:
+		if os.path.exists(temp_path):
+			os.remove(temp_path)
+	return path
+
+
+def render_thumbnail(path, preview_path, size):
+	"""
+	scales an image down to fit in a square
+	:param path: the path of the image
+	:param preview_path: the path to write the PNG thumbnail to
+	:param size: the width and height of the square in pixels
+	"""
+	with Image.open(path) as image:
+		image.thumbnail((size, size))
+		if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+			image = image.convert('RGBA')
+		image.save(preview_path, 'PNG')
+
+
+def render_pdf_page(path, preview_path, options):
+	"""
+	renders the first page of a PDF with pdftoppm (poppler-utils)
+	:param path: the path of the PDF
+	:param preview_path: the path to write the PNG render to
+	:param options: Dict of settings, see get_preview_options
+	"""
+	with tempfile.TemporaryDirectory(dir=os.path.dirname(preview_path)) as temp_dir:
+		output = os.path.join(temp_dir, 'page')
+		subprocess.run(['pdftoppm', '-png', '-singlefile', '-f', '1', '-l', '1', '-scale-to', str(options['size']),
+						path, output], check=True, timeout=options['timeout'], stdout=subprocess.DEVNULL,
+					stderr=subprocess.DEVNULL)
+		os.replace(output + '.png', preview_path)
+
+
+def extract_pdf_text(path, preview_path, options):
+	"""
+	extracts the text of the first page of a PDF with pdftotext (poppler-utils)
+	:param path: the path of the PDF
+	:param preview_path: the path to write the text snippet to
+	:param options: Dict of settings, see get_preview_options
+	"""
+	result = subprocess.run(['pdftotext', '-f', '1', '-l', '1', '-enc', 'UTF-8', path, '-'], check=True,
+							timeout=options['timeout'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+	with open(preview_path, 'w', encoding='utf-8') as preview:
+		preview.write(get_snippet(result.stdout[:options['text_bytes']], options['text_lines']))
+
+
+def write_text_snippet(path, preview_path, options):
+	"""
+	writes the first lines of a text file
+	:param path: the path of the text file
+	:param preview_path: the path to write the text snippet to
+	:param options: Dict of settings, see get_preview_options
+	"""
+	with open(path, 'rb') as file:
+		data = file.read(options['text_bytes'])
+	with open(preview_path, 'w', encoding='utf-8') as preview:
+		preview.write(get_snippet(data, options['text_lines']))
+
+
+def get_snippet(data, lines):
+	"""
+	gets the first lines of a text
+	:param data: the start of the text as bytes, may end halfway a character
+	:param lines: the maximum number of lines
+	:return: String containing the snippet
+	"""
+	text = data.decode('utf-8', errors='replace')
+	return '\n'.join(line.rstrip() for line in text.splitlines()[:lines])
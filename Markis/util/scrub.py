@@ -0,0 +1,143 @@
+# File containing functions for checking the filestore against the hashes of its files and the database
+#
+# Please always provide a function description
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from Markis.util import filestore, previews, compression
+
+# suffixes of the files derived from a stored file, see filestore.get_variant_path
+VARIANT_SUFFIXES = tuple(suffix for suffix, mimetype in previews.PREVIEW_VARIANTS) + (compression.GZIP_SUFFIX,)
+
+
+def hash_file(path, chunk_size, max_rate):
+	"""
+	hashes a stored file, reading at most max_rate bytes per second. Runs in a worker process.
+	:param path: the absolute path of the file
+	:param chunk_size: the number of bytes to read at a time
+	:param max_rate: the max number of bytes to read per second, None for no limit
+	:return: String containing the SHA-1 hash of the file, or None if it was removed in the meantime
+	"""
+	sha1 = hashlib.sha1()
+	start = time.monotonic()
+	read = 0
+	try:
+		with open(path, 'rb') as file:
+			for chunk in iter(lambda: file.read(chunk_size), b''):
+				sha1.update(chunk)
+				read += len(chunk)
+				if max_rate:
+					# sleep until reading this much would have taken as long as it is allowed to
+					delay = read / max_rate - (time.monotonic() - start)
+					if delay > 0:
+						time.sleep(delay)
+	except FileNotFoundError:
+		return None
+	return sha1.hexdigest()
+
+
+def classify_files(min_age):
+	"""
+	sorts the files in the filestore into stored files, variants and strays (files that should not be there,
+	such as the temporary files of uploads that died or files named after their upload)
+	:param min_age: seconds a file has to be old to be a stray, so uploads in progress are not
+	:return: Tuple of a Dict of file hash: path of the stored files, a Dict of file hash: List of paths of
+	the variants and a List of paths of the strays
+	"""
+	blobs = {}
+	variants = {}
+	strays = []
+	too_new = time.time() - min_age
+	for name, path in filestore.walk_files():
+		file_hash, _, suffix = name.partition('.')
+		if filestore.is_file_hash(file_hash) and not suffix:
+			# a file that is in both layouts is being migrated, the fanned out one is the one that is kept
+			if file_hash not in blobs or path == filestore.get_file_path(file_hash):
+				blobs[file_hash] = path
+		elif filestore.is_file_hash(file_hash) and suffix in VARIANT_SUFFIXES:
+			variants.setdefault(file_hash, []).append(path)
+		else:
+			try:
+				if os.path.getmtime(path) < too_new:
+					strays.append(path)
+			except FileNotFoundError:
+				pass
+	return blobs, variants, strays
+
+
+def read_checkpoint(path):
+	"""
+	reads where an interrupted scrub stopped
+	:param path: the path of the checkpoint file
+	:return: Dict with the last hash checked and the corrupt files found so far, or None if there is no checkpoint
+	"""
+	try:
+		with open(path) as checkpoint_file:
+			return json.load(checkpoint_file)
+	except (FileNotFoundError, ValueError):
+		return None
+
+
+def write_checkpoint(path, checkpoint):
+	"""
+	atomically stores where a scrub is, so it can continue there after it is interrupted
+	:param path: the path of the checkpoint file
+	:param checkpoint: Dict with the last hash checked and the corrupt files found so far
+	"""
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path + '.tmp', 'w') as checkpoint_file:
+		json.dump(checkpoint, checkpoint_file)
+	os.replace(path + '.tmp', path)
+
+
+def check_hashes(blobs, checkpoint_path, workers, max_rate, chunk_size, batch_size, log):
+	"""
+	re-hashes stored files in order of their hash, storing a checkpoint after every batch
+	:param blobs: Dict of file hash: path of the stored files, see classify_files
+	:param checkpoint_path: the path of the checkpoint file, None to always check all files
+	:param workers: the number of processes hashing files
+	:param max_rate: the max number of bytes to read per second in total, None for no limit
+	:param chunk_size: the number of bytes to read at a time
+	:param batch_size: the number of files to check between checkpoints
+	:param log: function to report progress with
+	:return: List of the hashes of files whose content does not match their hash
+	"""
+	checkpoint = (checkpoint_path and read_checkpoint(checkpoint_path)) or {'last_hash': '', 'corrupt': []}
+	if checkpoint['last_hash']:
+		log("continuing after %s" % checkpoint['last_hash'])
+	file_hashes = sorted(file_hash for file_hash in blobs if file_hash > checkpoint['last_hash'])
+	rate = max_rate / workers if max_rate else None
+	checked = 0
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		for start in range(0, len(file_hashes), batch_size):
+			batch = file_hashes[start:start + batch_size]
+			paths = [blobs[file_hash] for file_hash in batch]
+			for file_hash, actual_hash in zip(batch, pool.map(hash_file, paths, [chunk_size] * len(batch),
+																[rate] * len(batch))):
+				if actual_hash is not None and actual_hash != file_hash:
+					checkpoint['corrupt'].append(file_hash)
+			checked += len(batch)
+			checkpoint['last_hash'] = batch[-1]
+			if checkpoint_path:
+				write_checkpoint(checkpoint_path, checkpoint)
+			log("checked %d of %d files, %d corrupt" % (checked, len(file_hashes), len(checkpoint['corrupt'])))
+	# files found corrupt before an interruption may have been removed since
+	return [file_hash for file_hash in checkpoint['corrupt'] if file_hash in blobs]
+
+
+def quarantine_file(path, quarantine_dir):
+	"""
+	moves a file out of the filestore, keeping its path relative to the filestore so it can be put back
+	:param path: the absolute path of the file
+	:param quarantine_dir: the folder to move it to
+	:return: String containing the new path of the file
+	"""
+	target = os.path.join(quarantine_dir, os.path.relpath(path, filestore.get_filestore_dir()))
+	os.makedirs(os.path.dirname(target), exist_ok=True)
+	shutil.move(path, target)
+	return target
@@ -0,0 +1,199 @@
+# File containing functions for sending stored files to the client
+#
+# Please always provide a function description
+
+import os
+import uuid
+
+from flask import request, Response
+from werkzeug.http import http_date, parse_if_range_header
+
+from Markis import app
+from Markis.util import filestore
+
+READ_CHUNK_SIZE = 64 * 1024  # bytes read from disk at a time while sending a file
+
+
+def send_stored_file(path, etag, mimetype, filename, last_modified, disposition='inline', extra_headers=None,
+					fallback_path=None):
+	"""
+	sends a stored file, answering conditional requests with 304 and range requests with (multipart) 206.
+	Stored files never change, so they may be cached for as long as the client wants.
+	:param path: the absolute path of the file on disk
+	:param etag: the (strong) entity tag of the file, unquoted
+	:param mimetype: the content type of the file
+	:param filename: the name to show for the file
+	:param last_modified: datetime at which the file was uploaded
+	:param disposition: 'inline' to show the file in the browser, 'attachment' to download it
+	:param extra_headers: Dict of headers to send along, e.g. the Content-Encoding of a compressed variant
+	:param fallback_path: the path to send if path is gone, e.g. the filestore path of an evicted cached copy
+	:return: Response for the request
+	"""
+	headers = {
+		'ETag': '"%s"' % etag,
+		'Last-Modified': http_date(last_modified),
+		'Cache-Control': app.config['FILESTORE_CACHE_CONTROL'],
+		'Accept-Ranges': 'bytes',
+		'Content-Disposition': "%s; filename=%s" % (disposition, filename)
+	}
+	headers.update(extra_headers or {})
+
+	if is_not_modified(etag, last_modified):
+		return Response(status=304, headers=headers)
+	# the proxy only knows about the filestore, not about other folders such as the archive cache
+	if app.config['FILESTORE_OFFLOAD'] and path.startswith(filestore.get_filestore_dir() + os.sep):
+		return offload_stored_file(path, mimetype, headers)
+
+	# once it is open, the file can be sent completely even if it is removed in the meantime
+	try:
+		file = open(path, 'rb')
+	except FileNotFoundError:
+		if fallback_path is None:
+			raise
+		file = open(fallback_path, 'rb')
+	size = os.fstat(file.fileno()).st_size
+	ranges = get_requested_ranges(size, etag, last_modified)
+	if ranges is None:
+		headers['Content-Length'] = str(size)
+		response = Response(read_open_file(file, 0, size), 200, headers, mimetype=mimetype, direct_passthrough=True)
+	elif not ranges:
+		file.close()
+		headers['Content-Range'] = "bytes */%d" % size
+		return Response(status=416, headers=headers)
+	elif len(ranges) == 1:
+		start, stop = ranges[0]
+		headers['Content-Range'] = "bytes %d-%d/%d" % (start, stop - 1, size)
+		headers['Content-Length'] = str(stop - start)
+		response = Response(read_open_file(file, start, stop - start), 206, headers, mimetype=mimetype,
+							direct_passthrough=True)
+	else:
+		response = send_multiple_ranges(file, ranges, size, mimetype, headers)
+	response.call_on_close(file.close)
+	return response
+
+
+def offload_stored_file(path, mimetype, headers):
+	"""
+	lets the front proxy send a file (nginx X-Accel-Redirect or apache/lighttpd X-Sendfile), so no worker is
+	busy during the transfer. The proxy takes care of range requests itself.
+	:param path: the absolute path of the file on disk
+	:param mimetype: the content type of the file
+	:param headers: Dict of headers to send along
+	:return: Response without a body
+	"""
+	headers = dict(headers)
+	if app.config['FILESTORE_OFFLOAD'] == 'x-accel-redirect':
+		relative_path = os.path.relpath(path, filestore.get_filestore_dir()).replace(os.sep, '/')
+		headers['X-Accel-Redirect'] = app.config['FILESTORE_ACCEL_PREFIX'].rstrip('/') + '/' + relative_path
+	elif app.config['FILESTORE_OFFLOAD'] == 'x-sendfile':
+		headers['X-Sendfile'] = path
+	else:
+		raise ValueError("Unknown FILESTORE_OFFLOAD mode %s" % app.config['FILESTORE_OFFLOAD'])
+	return Response(status=200, headers=headers, mimetype=mimetype)
+
+
+def is_not_modified(etag, last_modified):
+	"""
+	checks whether the client already has the current version of a file, following RFC 7232
+	:param etag: the entity tag of the file, unquoted
+	:param last_modified: datetime at which the file was uploaded
+	:return: Boolean whether a 304 Not Modified response should be sent
+	"""
+	if request.method not in ('GET', 'HEAD'):
+		return False
+	if 'If-None-Match' in request.headers:
+		return request.if_none_match.contains_weak(etag)
+	if request.if_modified_since is not None:
+		return last_modified.replace(microsecond=0, tzinfo=None) <= request.if_modified_since.replace(tzinfo=None)
+	return False
+
+
+def get_requested_ranges(size, etag, last_modified):
+	"""
+	gets the byte ranges requested by the client
+	:param size: the size of the file in bytes
+	:param etag: the entity tag of the file, unquoted
+	:param last_modified: datetime at which the file was uploaded
+	:return: None if the whole file should be sent, otherwise a List of (start, stop) Tuples of the
+	satisfiable ranges, stop being exclusive (an empty list if none of them can be satisfied)
+	"""
+	requested = request.range
+	if requested is None or requested.units != 'bytes':
+		return None
+	if 'If-Range' in request.headers:
+		# only send a part if the client has a part of this very file
+		if_range = parse_if_range_header(request.headers['If-Range'])
+		if if_range.etag is not None and if_range.etag != etag:
+			return None
+		if if_range.date is not None and if_range.date.replace(tzinfo=None) != last_modified.replace(microsecond=0,
+																								tzinfo=None):
+			return None
+
+	ranges = []
+	for start, stop in requested.ranges:
+		if start < 0:
+			# suffix range, the last -start bytes
+			start, stop = max(size + start, 0), size
+		else:
+			stop = size if stop is None else min(stop, size)
+		if start < stop:
+			ranges.append((start, stop))
+	return ranges
+
+
+def send_multiple_ranges(file, ranges, size, mimetype, headers):
+	"""
+	sends several parts of a file as a multipart/byteranges response
+	:param file: the file, opened for reading in binary mode
+	:param ranges: List of (start, stop) Tuples, stop being exclusive
+	:param size: the size of the file in bytes
+	:param mimetype: the content type of the file
+	:param headers: Dict of headers to send along
+	:return: Response with status 206
+	"""
+	boundary = uuid.uuid4().hex
+	part_headers = [("\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n"
+					% (boundary, mimetype, start, stop - 1, size)).encode('latin-1') for start, stop in ranges]
+	closing = ("\r\n--%s--\r\n" % boundary).encode('latin-1')
+
+	def generate():
+		for part_header, (start, stop) in zip(part_headers, ranges):
+			yield part_header
+			for chunk in read_open_file(file, start, stop - start):
+				yield chunk
+		yield closing
+
+	headers['Content-Length'] = str(sum(len(part_header) for part_header in part_headers)
+									+ sum(stop - start for start, stop in ranges) + len(closing))
+	return Response(generate(), 206, headers, content_type="multipart/byteranges; boundary=%s" % boundary,
+					direct_passthrough=True)
+
+
+def read_file(path, start, length):
+	"""
+	reads a part of a file in chunks, so large files are never held in memory
+	:param path: the absolute path of the file on disk
+	:param start: the offset to start reading at
+	:param length: the number of bytes to read
+	:return: Generator of byte strings
+	"""
+	with open(path, 'rb') as file:
+		for chunk in read_open_file(file, start, length):
+			yield chunk
+
+
+def read_open_file(file, start, length):
+	"""
+	reads a part of an open file in chunks, so large files are never held in memory
+	:param file: the file, opened for reading in binary mode
+	:param start: the offset to start reading at
+	:param length: the number of bytes to read
+	:return: Generator of byte strings
+	"""
+	file.seek(start)
+	while length > 0:
+		chunk = file.read(min(length, READ_CHUNK_SIZE))
+		if not chunk:
+			break
+		length -= len(chunk)
+		yield chunk
@@ -0,0 +1,301 @@
+# File containing functions for receiving uploads, in one request or in chunks over several (resumable) requests
+#
+# Please always provide a function description
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from sqlalchemy.exc import IntegrityError
+
+from Markis import app
+from Markis.models import db, File
+from Markis.util import filestore, metadata, previews, compression, folders
+
+SESSION_FILE = 'session.json'
+CHUNK_PREFIX = 'chunk-'
+
+
+class SessionCollector(object):
+	"""Removes upload sessions that have not received a chunk for UPLOAD_SESSION_TTL seconds,
+	checking every <interval> seconds in a background thread.
+	"""
+
+	def __init__(self, interval):
+		self.interval = interval
+		self.runs = 0
+		self.removed = 0
+		self.last_run = None
+		self._thread = None
+
+	def collect(self):
+		"""Remove the abandoned upload sessions
+		:return: Integer number of sessions removed
+		"""
+		removed = 0
+		expired = time.time() - app.config['UPLOAD_SESSION_TTL']
+		try:
+			with os.scandir(get_sessions_dir()) as entries:
+				sessions = [entry.path for entry in entries if entry.is_dir()]
+		except FileNotFoundError:
+			sessions = []
+		for session_dir in sessions:
+			try:
+				last_active = os.path.getmtime(os.path.join(session_dir, SESSION_FILE))
+			except FileNotFoundError:
+				# a session that is being set up or removed, or was never set up completely
+				last_active = os.path.getmtime(session_dir) if os.path.isdir(session_dir) else expired
+			if last_active <= expired:
+				shutil.rmtree(session_dir, ignore_errors=True)
+				removed += 1
+		self.removed += removed
+		self.runs += 1
+		self.last_run = time.time()
+		return removed
+
+	def start(self):
+		"""Start collecting abandoned sessions in a background thread, if not started yet"""
+		if self._thread is None:
+			self._thread = threading.Thread(target=self._run, name='upload-session-collector', daemon=True)
+			self._thread.start()
+
+	def _run(self):
+		while True:
+			try:
+				self.collect()
+			except OSError as e:
+				app.logger.warning("Collecting abandoned upload sessions failed: %s", e)
+			time.sleep(self.interval)
+
+	def stats(self):
+		"""
+		gets the counters of the collector
+		:return: Dict of the runs, removed sessions and time of the last run
+		"""
+		return {'runs': self.runs, 'removed': self.removed, 'last_run': self.last_run}
+
+
+session_collector = SessionCollector(app.config['UPLOAD_SESSION_COLLECT_INTERVAL'])
+
+
+class ChunkReader(object):
+	"""Read-only file that reads a list of files one after another, so chunks can be stored like a single upload"""
+
+	def __init__(self, paths):
+		self._paths = list(paths)
+		self._file = None
+
+	def read(self, size):
+		while True:
+			if self._file is None:
+				if not self._paths:
+					return b''
+				self._file = open(self._paths.pop(0), 'rb')
+			data = self._file.read(size)
+			if data:
+				return data
+			self._file.close()
+			self._file = None
+
+	def close(self):
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+
+
+def store_upload(stream, filename, mimetype, subject_id, display_path, uploader_username):
+	"""
+	stores an uploaded file in the filestore and adds it to the database, unless it is uploaded already
+	:param stream: file-like object to read the file from
+	:param filename: the name of the file
+	:param mimetype: the content type of the file
+	:param subject_id: the subject the file is uploaded to
+	:param display_path: the folder the file is uploaded to
+	:param uploader_username: the username of the uploader
+	:return: String containing the reason the file was not stored, or None if it was stored
+	"""
+	# hash while receiving, so a duplicate never lands in the filestore
+	file_hash, temp_path = filestore.receive_file(stream)
+	if File.query.filter(File.file_hash == file_hash).first():
+		filestore.discard_file(temp_path)
+		return "That file is already uploaded"
+	file_metadata = metadata.read_metadata(temp_path, mimetype)
+	filestore.store_file(temp_path, file_hash)
+
+	folders.create_folders(subject_id, display_path)
+	db_file = File(file_hash=file_hash, name=filename, display_path=display_path, subject_id=subject_id,
+				uploader_username=uploader_username, type=mimetype, **file_metadata)
+	db.session.add(db_file)
+	try:
+		folders.add_file(subject_id, display_path, file_metadata['size'])
+		db.session.commit()
+	except IntegrityError:
+		# the same file was uploaded at the same time, the blob on disk belongs to that upload now
+		db.session.rollback()
+		return "That file is already uploaded"
+	previews.queue_preview(file_hash, mimetype)
+	compression.queue_compression(file_hash, mimetype)
+	return None
+
+
+def get_sessions_dir():
+	"""
+	gets the directory in which the chunks of resumable uploads are kept
+	:return: String containing the absolute path of the upload sessions
+	"""
+	return os.path.join(app.root_path, app.config['UPLOAD_SESSION_DIR'])
+
+
+def get_session_dir(upload_id):
+	"""
+	gets the directory of an upload session
+	:param upload_id: the id of the upload session
+	:return: String containing the absolute path of the session, or None if the id is not valid
+	"""
+	try:
+		upload_id = uuid.UUID(upload_id).hex
+	except ValueError:
+		return None
+	return os.path.join(get_sessions_dir(), upload_id)
+
+
+def create_session(filename, mimetype, size, subject_id, display_path, uploader_username):
+	"""
+	starts a resumable upload
+	:param filename: the name of the file
+	:param mimetype: the content type of the file
+	:param size: the size of the file in bytes
+	:param subject_id: the subject the file is uploaded to
+	:param display_path: the folder the file is uploaded to
+	:param uploader_username: the username of the uploader
+	:return: Dict describing the session, see get_session
+	"""
+	chunk_size = app.config['UPLOAD_SESSION_CHUNK_SIZE']
+	upload = {'upload_id': uuid.uuid4().hex, 'name': filename, 'type': mimetype, 'size': size,
+			'subject_id': subject_id, 'display_path': display_path, 'uploader_username': uploader_username,
+			'chunk_size': chunk_size, 'chunk_count': max((size + chunk_size - 1) // chunk_size, 1)}
+	session_dir = get_session_dir(upload['upload_id'])
+	os.makedirs(session_dir)
+	with open(os.path.join(session_dir, SESSION_FILE), 'w') as session_file:
+		json.dump(upload, session_file)
+	return upload
+
+
+def get_session(upload_id, uploader_username):
+	"""
+	gets an upload session of a user
+	:param upload_id: the id of the upload session
+	:param uploader_username: the username of the user asking for it
+	:return: Dict with the upload_id, name, type, size, subject_id, display_path, uploader_username, chunk_size and
+	chunk_count of the session, or None if the user has no such session
+	"""
+	session_dir = get_session_dir(upload_id)
+	if session_dir is None:
+		return None
+	try:
+		with open(os.path.join(session_dir, SESSION_FILE)) as session_file:
+			upload = json.load(session_file)
+	except (FileNotFoundError, ValueError):
+		return None
+	if upload['uploader_username'] != uploader_username:
+		return None
+	return upload
+
+
+def get_chunk_size(upload, index):
+	"""
+	gets the size a chunk of an upload has to be, all chunks are chunk_size bytes except the last one
+	:param upload: Dict describing the session, see get_session
+	:param index: the index of the chunk
+	:return: Integer size of the chunk in bytes, or None if the upload has no such chunk
+	"""
+	if not 0 <= index < upload['chunk_count']:
+		return None
+	return min(upload['chunk_size'], upload['size'] - index * upload['chunk_size'])
+
+
+def get_chunk_path(upload, index):
+	"""
+	gets the path at which a chunk of an upload is kept
+	:param upload: Dict describing the session, see get_session
+	:param index: the index of the chunk
+	:return: String containing the absolute path of the chunk
+	"""
+	return os.path.join(get_session_dir(upload['upload_id']), "%s%d" % (CHUNK_PREFIX, index))
+
+
+def receive_chunk(upload, index, stream, checksum):
+	"""
+	stores a chunk of an upload. Chunks may be sent in any order, at the same time and more than once.
+	:param upload: Dict describing the session, see get_session
+	:param index: the index of the chunk
+	:param stream: file-like object to read the chunk from
+	:param checksum: the SHA-1 hash of the chunk as sent by the client, lower case hex
+	:return: String containing the reason the chunk was not stored, or None if it was stored
+	"""
+	expected_size = get_chunk_size(upload, index)
+	if expected_size is None:
+		return "The upload has no chunk %d" % index
+	session_dir = get_session_dir(upload['upload_id'])
+	temp_path = os.path.join(session_dir, "%s%s" % (filestore.TEMP_PREFIX, uuid.uuid4().hex))
+	sha1 = hashlib.sha1()
+	size = 0
+	try:
+		with open(temp_path, 'wb') as temp_file:
+			for data in iter(lambda: stream.read(app.config['UPLOAD_CHUNK_SIZE']), b''):
+				size += len(data)
+				if size > expected_size:
+					return "Chunk %d should be %d bytes" % (index, expected_size)
+				sha1.update(data)
+				temp_file.write(data)
+		if size != expected_size:
+			return "Chunk %d should be %d bytes" % (index, expected_size)
+		if sha1.hexdigest() != checksum:
+			return "The checksum of chunk %d does not match" % index
+		# a chunk is either there completely or not at all
+		os.replace(temp_path, get_chunk_path(upload, index))
+		os.utime(os.path.join(session_dir, SESSION_FILE))
+		return None
+	finally:
+		if os.path.exists(temp_path):
+			os.remove(temp_path)
+
+
+def get_received_chunks(upload):
+	"""
+	lists the chunks of an upload that have been received
+	:param upload: Dict describing the session, see get_session
+	:return: List of the indexes of the received chunks, in order
+	"""
+	with os.scandir(get_session_dir(upload['upload_id'])) as entries:
+		return sorted(int(entry.name[len(CHUNK_PREFIX):]) for entry in entries if entry.name.startswith(CHUNK_PREFIX))
+
+
+def finish_session(upload):
+	"""
+	assembles the chunks of an upload and stores the file, removing the session
+	:param upload: Dict describing the session, see get_session
+	:return: String containing the reason the file was not stored, or None if it was stored
+	"""
+	if len(get_received_chunks(upload)) != upload['chunk_count']:
+		return "Not all chunks have been received"
+	reader = ChunkReader(get_chunk_path(upload, index) for index in range(upload['chunk_count']))
+	try:
+		error = store_upload(reader, upload['name'], upload['type'], upload['subject_id'], upload['display_path'],
+							upload['uploader_username'])
+	finally:
+		reader.close()
+	remove_session(upload)
+	return error
+
+
+def remove_session(upload):
+	"""
+	removes an upload session and its chunks
+	:param upload: Dict describing the session, see get_session
+	"""
+	shutil.rmtree(get_session_dir(upload['upload_id']), ignore_errors=True)
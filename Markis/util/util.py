@@ -7,11 +7,17 @@ from urllib.parse import urlparse, urljoin
 import datetime
 
 import os
-from sqlalchemy import text
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import or_, and_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
 from sqlalchemy.sql import func
-from Markis import app
+from Markis import app, user_cache
 from flask import request
-from Markis.models import File, Subject, Faculty, Vote, Favorite, db, User
+from Markis.models import File, Subject, Faculty, Vote, Favorite, db, fetch_crowd_profile
+from Markis.util import filestore, folders
+from Markis.util.crowd import CrowdUnavailableError
 
 
 def is_safe_url(target):
@@ -40,14 +46,8 @@ def folder_has_contents(subject_id, sub_folder_path):
 						True: The folder has contents
 						False: the folder has no contents
 			"""
-	files = File.query.filter(File.subject_id == subject_id).filter(File.display_path.contains(sub_folder_path)).all()
-	if len(files) <= 0:
-		return False
-	for file in files:
-		file = file.__dict__
-		if file_exists(file['file_hash']):
-			return True
-	return False
+	folder = folders.get_folder(subject_id, sub_folder_path)
+	return folder is not None and folder.file_count > 0
 
 
 def get_subject_folders(subject_id):
@@ -60,9 +60,10 @@ def get_subject_folders(subject_id):
 						boolean: Folder has content
 		"""
 	folders_to_show = []
-	folders = app.config['SUBJECT_SUBFOLDERS']
-	for subFolder in folders:
-		info = {'name': subFolder, 'hasContent': folder_has_contents(subject_id, subFolder)}
+	subject_folders = folders.get_subfolders(subject_id, '')
+	for subFolder in app.config['SUBJECT_SUBFOLDERS']:
+		folder = subject_folders.get(subFolder)
+		info = {'name': subFolder, 'hasContent': folder is not None and folder.file_count > 0}
 		folders_to_show.append(info)
 	return folders_to_show
 
@@ -92,6 +93,10 @@ def get_folders_to_show(subject_id, subfolder):
 								Dict:
 									name: Folders name
 									hasContent: Folder has content
+									file_count: Number of files in the folder and its sub-folders
+									size: Formatted total size of those files
+									last_upload: Date of the last upload to the folder
+									questions, answers: Year period has questions/answers (year periods only)
 				"""
 	first_subfolder = subfolder.split('/')[0]
 	nrof_subfolders = len(subfolder.split('/'))
@@ -101,21 +106,33 @@ def get_folders_to_show(subject_id, subfolder):
 		return []
 	elif first_subfolder in {'exams', 'homework'}:
 		if nrof_subfolders == 1:
-			# show year periods for which files exist
-			display_paths = File.query.filter(File.display_path.like(first_subfolder + '%'))\
-				.filter(File.subject_id == subject_id).with_entities(File.display_path).all()
-			for path in display_paths:
-				path = dict(zip(path.keys(), path))
-				yearperiod = {'name': path['display_path'].split('/')[1], 'hasContent': True}  # True as always contains files
-				folders_to_show.append(yearperiod)
+			# show year periods for which files exist, newest first
+			for period in folders.get_year_periods(subject_id, subfolder):
+				period['hasContent'] = True
+				set_folder_totals(period)
+				folders_to_show.append(period)
 		if nrof_subfolders == 2:
 			# return questions/answer folders, regardless of content
-			last_folders = [{'name': "questions", 'hasContent': folder_has_contents(subject_id, subfolder + "/" + "questions")},
-							{'name': "answers", 'hasContent': folder_has_contents(subject_id, subfolder + "/" + "answers")}]
-			folders_to_show = last_folders
+			type_folders = folders.get_subfolders(subject_id, subfolder)
+			for name in ("questions", "answers"):
+				folder = type_folders.get(name)
+				info = {'name': name, 'hasContent': folder is not None and folder.file_count > 0,
+						'file_count': folder.file_count if folder else 0, 'total_bytes': folder.total_bytes if folder else 0,
+						'last_upload': folder.last_upload if folder else None}
+				set_folder_totals(info)
+				folders_to_show.append(info)
 	return folders_to_show
 
 
+def set_folder_totals(folder):
+	"""formats the totals of a listed folder like those of files
+		Args:
+			folder: Dict of the folder, containing total_bytes and last_upload
+	"""
+	folder['size'] = format_file_size(folder['total_bytes']) if folder['file_count'] else ''
+	folder['upload_date'] = folder['last_upload'].date() if folder['last_upload'] else ''
+
+
 def get_user_file_vote(file_id, username):
 	"""get the vote of a user on a file
 		Args:
@@ -132,6 +149,67 @@ def get_user_file_vote(file_id, username):
 		return vote.vote
 
 
+def set_user_file_vote(file_id, username, current_vote, new_vote):
+	"""change the vote of a user on a file, updating the vote totals of the file in the same transaction.
+	The vote is only changed if it still is current_vote, and the totals are changed relative to their
+	current value, so concurrent votes are never lost.
+		Args:
+			file_id: The file id to vote on
+			username: username of the voter
+			current_vote: the vote of the user as read before (+1, -1 or 0 for no vote)
+			new_vote: the new vote of the user (+1, -1 or 0 to remove the vote)
+		Returns:
+			Boolean:
+				whether the vote was changed, False if it was changed by another request in the meantime
+	"""
+	user_vote = Vote.query.filter(Vote.file_id == file_id, Vote.user_username == username)
+	try:
+		if current_vote == 0:
+			db.session.execute(Vote.__table__.insert().values(file_id=file_id, user_username=username, vote=new_vote))
+			changed = 1
+		elif new_vote == 0:
+			changed = user_vote.filter(Vote.vote == current_vote).delete(synchronize_session=False)
+		else:
+			changed = user_vote.filter(Vote.vote == current_vote).update({Vote.vote: new_vote},
+																		synchronize_session=False)
+		if changed != 1:
+			db.session.rollback()
+			return False
+		upvotes = int(new_vote == 1) - int(current_vote == 1)
+		downvotes = int(new_vote == -1) - int(current_vote == -1)
+		File.query.filter(File.file_id == file_id).update({
+			File.score: File.score + (new_vote - current_vote),
+			File.upvotes: File.upvotes + upvotes,
+			File.downvotes: File.downvotes + downvotes
+		}, synchronize_session=False)
+		db.session.commit()
+	except IntegrityError:
+		# the user voted for the first time in another request at the same time
+		db.session.rollback()
+		return False
+	return True
+
+
+def reconcile_file_scores(first_file_id, last_file_id):
+	"""recompute the vote totals of files from their votes
+		Args:
+			first_file_id: the first file id of the files to recompute
+			last_file_id: the last file id of the files to recompute
+		Returns:
+			Integer:
+				the number of files whose totals were wrong
+	"""
+	score = db.session.query(func.coalesce(func.sum(Vote.vote), 0)).filter(
+		Vote.file_id == File.file_id).scalar_subquery()
+	upvotes = db.session.query(func.count()).filter(Vote.file_id == File.file_id, Vote.vote == 1).scalar_subquery()
+	downvotes = db.session.query(func.count()).filter(Vote.file_id == File.file_id, Vote.vote == -1).scalar_subquery()
+	fixed = File.query.filter(File.file_id.between(first_file_id, last_file_id),
+							or_(File.score != score, File.upvotes != upvotes, File.downvotes != downvotes)).update(
+		{File.score: score, File.upvotes: upvotes, File.downvotes: downvotes}, synchronize_session=False)
+	db.session.commit()
+	return fixed
+
+
 def get_user_file_favorite(file_id, username):
 	"""get the favorite of a user on a file
 			Args:
@@ -150,12 +228,11 @@ def get_user_file_favorite(file_id, username):
 
 def file_exists(file_hash):
 	"""
-		checks whether a file exists on disk
+		checks whether a file exists in the filestore, using the in-memory index of stored files
 		:param file_hash: the hash of the file for which to check it's existence
 		:return: Boolean whether it exists or not
 		"""
-	file_path = os.path.join(app.root_path, app.config["FILESTORE_DIR"], file_hash)
-	return os.path.isfile(file_path)
+	return file_hash in filestore.presence_index
 
 
 def get_file_size(file_hash):
@@ -165,11 +242,20 @@ def get_file_size(file_hash):
 	:return: String containing the file's size in bytes, kilobytes, megabytes or gigabytes
 	"""
 
-	file_path = os.path.join(app.root_path, app.config["FILESTORE_DIR"], file_hash)
+	file_path = filestore.find_file(file_hash)
 	try:
 		file_size = os.path.getsize(file_path)
-	except FileNotFoundError:
+	except (FileNotFoundError, TypeError):
 		return None
+	return format_file_size(file_size)
+
+
+def format_file_size(file_size):
+	"""
+	formats a file size in b, kb, mb or gb
+	:param file_size: the size of a file in bytes
+	:return: String containing the file's size in bytes, kilobytes, megabytes or gigabytes
+	"""
 	if file_size >= (1024**3):
 		file_size_string = str(round(file_size/(1024**3), 1)) + " GB"
 	elif file_size >= (1024**2):
@@ -181,6 +267,18 @@ def get_file_size(file_hash):
 	return file_size_string
 
 
+def set_file_size(file):
+	"""
+	sets the formatted size of a listed file, using the size stored with the file
+	and only looking at the disk for files of which the size was not stored yet
+	:param file: Dict of the file, containing file_hash and size_bytes
+	"""
+	if file['size_bytes'] is None:
+		file_path = filestore.find_file(file['file_hash'])
+		file['size_bytes'] = os.path.getsize(file_path) if file_path else 0
+	file['size'] = format_file_size(file['size_bytes'])
+
+
 def get_files_to_show(subject_id, subfolder, username):
 	"""get all files to show in a certain subfolder
 		Args:
@@ -192,32 +290,132 @@ def get_files_to_show(subject_id, subfolder, username):
 				Files
 	"""
 	files = []
-	# I know, should be with models to allow non-sql server to process it as well
-	# so please feel free to translate this mess. If you do I'll buy you a beer
-	s = text(
-		"SELECT files.file_id, files.name, files.file_hash, files.type, DATE(files.upload_date) AS upload_date, "
-		"IFNULL(SUM(user_file_vote.vote), 0) AS votes, files.uploader_username "
-		"FROM files LEFT JOIN user_file_vote ON user_file_vote.file_id = files.file_id "
-		"WHERE files.display_path = :p and files.subject_id = :s;")
-	files_in_dir = db.engine.execute(s, p=subfolder, s=subject_id).fetchall()
+	# one query for the whole folder, the vote totals are stored with the files
+	user_vote = aliased(Vote)
+	user_favorite = aliased(Favorite)
+	files_in_dir = db.session.query(
+		File.file_id, File.name, File.file_hash, File.type, func.DATE(File.upload_date).label("upload_date"),
+		File.score.label("votes"), File.uploader_username, File.size.label("size_bytes"),
+		func.coalesce(user_vote.vote, 0).label("user_vote"), user_favorite.file_id.isnot(None).label("user_favorite")
+	).outerjoin(
+		user_vote, and_(user_vote.file_id == File.file_id, user_vote.user_username == username)).outerjoin(
+		user_favorite, and_(user_favorite.file_id == File.file_id, user_favorite.user_username == username)).filter(
+		File.display_path == subfolder, File.subject_id == subject_id).all()
 
 	for file in files_in_dir:
 		file = dict(zip(file.keys(), file))
-		if file['file_id'] is not None:
-			if file_exists(file["file_hash"]):
-				try:
-					file['uploader_displayname'] = User(file['uploader_username']).displayname
-				except ValueError:
-					file['uploader_displayname'] = file['uploader_username']  # if user is not found, just show his username
-				file['user_vote'] = get_user_file_vote(file['file_id'], username)
-				file['user_favorite'] = get_user_file_favorite(file['file_id'], username)
-				file['size'] = get_file_size(file['file_hash'])
-				file['downloadpath'] = app.config['FILESTORE_PATH'] + "/" + file['file_hash']
-
-				files.append(file)
+		if file_exists(file["file_hash"]):
+			set_file_size(file)
+			file['downloadpath'] = app.config['FILESTORE_PATH'] + "/" + file['file_hash']
+			file['previewpath'] = "/preview/" + file['file_hash']
+
+			files.append(file)
+
+	# resolve all uploaders at once, so the number of crowd requests doesn't grow with the number of files
+	displaynames = get_displaynames(file['uploader_username'] for file in files)
+	for file in files:
+		file['uploader_displayname'] = displaynames[file['uploader_username']]
 	return files
 
 
+def get_displaynames(usernames):
+	"""get the display names for a collection of users, fetching the ones not in the user cache concurrently
+		Args:
+			usernames: iterable of usernames, may contain duplicates
+		Returns:
+			Dict:
+				username: display name of the user, or the username itself if the user cannot be found
+	"""
+	displaynames = {}
+	missing = []
+	for username in set(usernames):
+		profile = user_cache.get(username)
+		if profile is not None:
+			displaynames[username] = profile['user']['display-name']
+		elif user_cache.get(('missing', username)):
+			displaynames[username] = username
+		else:
+			missing.append(username)
+
+	if missing:
+		with ThreadPoolExecutor(max_workers=min(len(missing), app.config['CROWD_LOOKUP_WORKERS'])) as pool:
+			for username, profile in zip(missing, pool.map(fetch_displayname_profile, missing)):
+				if profile is not None:
+					displaynames[username] = profile['user']['display-name']
+				else:
+					displaynames[username] = username  # if user is not found, just show his username
+	return displaynames
+
+
+def fetch_displayname_profile(username):
+	"""fetch the crowd profile of a user, without failing the listing if crowd cannot be reached
+		Args:
+			username: the username for which to fetch the profile
+		Returns:
+			Dict: the (possibly stale) crowd profile of the user
+			None: if the user does not exist or crowd could not be reached
+	"""
+	try:
+		profile = fetch_crowd_profile(username)
+	except CrowdUnavailableError:
+		return user_cache.get_stale(username)
+	if profile is None:
+		# accounts of uploaders that left are removed, don't ask crowd about them on every listing
+		user_cache.set(('missing', username), True, ttl=app.config['USER_CACHE_MISSING_TTL'])
+	return profile
+
+
+def get_archive_entries(subject_id, subfolder):
+	"""get all stored files in a folder and its sub-folders, to put in an archive
+		Args:
+			subject_id: the subject ID in which we're looking
+			subfolder: The (display) path of the folder
+		Returns:
+			List:
+				Tuple: file hash, path on disk, name in the archive, content type and upload date
+	"""
+	files = File.query.filter(File.subject_id == subject_id)\
+		.filter(or_(File.display_path == subfolder,
+					File.display_path.like(folders.get_below_pattern(subfolder), escape=folders.LIKE_ESCAPE)))\
+		.order_by(File.display_path, File.name).all()
+
+	entries = []
+	arcnames = set()
+	for file in files:
+		path = filestore.find_file(file.file_hash)
+		if path is None:
+			continue
+		folder = file.display_path[len(subfolder):].strip('/')
+		name = file.name.replace('/', '_').replace('\\', '_')
+		arcname = posixpath.join(folder, name)
+		# two files may have the same name, add a number to the later ones
+		base, extension = posixpath.splitext(arcname)
+		number = 1
+		while arcname in arcnames:
+			number += 1
+			arcname = "%s (%d)%s" % (base, number, extension)
+		arcnames.add(arcname)
+		entries.append((file.file_hash, path, arcname, file.type, file.upload_date))
+	return entries
+
+
+def get_upload_display_path(category, opt1, opt2):
+	"""get the folder a file is uploaded to from the options of the upload form
+		Args:
+			category: The subject subfolder, e.g. exams
+			opt1: The first year of the year period, only for exams and homework
+			opt2: The type (questions or answers), only for exams and homework
+		Returns:
+			String: The display path of the folder
+			None: If the year period or type is missing
+	"""
+	if category != "exams" and category != "homework":
+		return category
+	if not opt1 or not opt1.isdigit() or not opt2 or opt2 == "type":
+		return None
+	return category + "/" + opt1 + "-" + str(int(opt1) + 1) + "/" + opt2
+
+
 def get_years_list():
 	"""get all year periods
 		Returns:
@@ -245,7 +443,8 @@ def get_favorite_files(username):
 	"""
 	files_to_show = []
 	file_list = db.session.query(Favorite.file_id, Favorite.user_username, File.name, File.type, File.file_hash,
-								func.DATE(File.upload_date).label("upload_date"), File.display_path, File.uploader_username, File.subject_id).filter(
+								func.DATE(File.upload_date).label("upload_date"), File.display_path, File.uploader_username, File.subject_id,
+								File.size.label("size_bytes")).filter(
 								Favorite.user_username == username).join(
 								File, Favorite.file_id == File.file_id).all()
 	if not file_list:
@@ -253,7 +452,7 @@ def get_favorite_files(username):
 	for file in file_list:
 		file = dict(zip(file.keys(), file))
 		if file_exists(file["file_hash"]):
-			file['size'] = get_file_size(file['file_hash'])
+			set_file_size(file)
 			file['downloadpath'] = app.config['FILESTORE_PATH'] + "/" + file['file_hash']
 			files_to_show.append(file)
 	return files_to_show
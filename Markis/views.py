@@ -1,15 +1,18 @@
-import hashlib
 import mimetypes
 
 import os
 from flask_principal import identity_changed, AnonymousIdentity, Identity
-from . import app, crowdServer, current_user
+from . import app, crowdServer, current_user, user_cache, session_cache, admin_group, admin_permission
 from flask import render_template, request, send_from_directory, redirect, url_for, flash, abort, send_file, \
-	json, make_response, current_app, session
+	json, make_response, current_app, session, Response, stream_with_context
 from flask_login import login_user, logout_user, login_required
 from .models import Subject, Faculty, User, File, Favorite, db, Vote
-from .forms import LoginForm, RegisterForm, UploadFileForm
-from .util import util
+from .forms import LoginForm, RegisterForm, UploadFileForm, remember_duplicate
+from .util import util, filestore, transfer, archive, previews, compression, uploads, folders
+from .util.crowd import CrowdUnavailableError
+from .util.blobcache import blob_cache
+
+CROWD_UNAVAILABLE_MESSAGE = "The authentication service is temporarily unavailable, please try again later"
 
 
 @app.route('/')
@@ -26,6 +29,16 @@ def home():
 
 @app.route("/logout")
 def logout():
+	if current_user.is_authenticated:
+		user_cache.invalidate(current_user.get_id())
+	token = session.pop('crowd_token', None)
+	if token:
+		session_cache.invalidate(token)
+		try:
+			crowdServer.terminate_session(token)
+		except CrowdUnavailableError as e:
+			# log out here anyway, the crowd session expires by itself
+			app.logger.warning("Terminating a crowd session failed: %s", e)
 	logout_user()
 
 	# Remove session keys set by Flask-Principal
@@ -48,8 +61,25 @@ def login():
 			user = User(form.username.data)
 		except ValueError:
 			return render_template('login.html', error='Username not found', form=form)
+		except CrowdUnavailableError:
+			flash(CROWD_UNAVAILABLE_MESSAGE, 'danger')
+			return render_template('login.html', form=form)
+
+		try:
+			if app.config['CROWD_AUTH_MODE'] == 'session':
+				token = user.create_session(form.password.data, request.remote_addr)
+				if token:
+					session['crowd_token'] = token
+					# the crowd token has to outlive the browser session as well when the user stays logged in
+					session.permanent = form.keepLoggedIn.data
+				authenticated = token is not None
+			else:
+				authenticated = user.authenticate(form.username.data, form.password.data)
+		except CrowdUnavailableError:
+			flash(CROWD_UNAVAILABLE_MESSAGE, 'danger')
+			return render_template('login.html', form=form)
 
-		if user.authenticate(form.username.data, form.password.data):
+		if authenticated:
 			login_user(user, remember=form.keepLoggedIn.data)
 			identity_changed.send(current_app._get_current_object(),
 								identity=Identity(user.username))
@@ -67,7 +97,13 @@ def login():
 @app.route('/register', methods=['GET', 'POST'])
 def register():
 	form = RegisterForm(request.form)
-	if request.method == 'POST' and form.validate():
+	try:
+		valid = request.method == 'POST' and form.validate()
+	except CrowdUnavailableError:
+		# the duplicate checks of the form ask crowd as well
+		flash(CROWD_UNAVAILABLE_MESSAGE, 'danger')
+		return render_template('register.html', form=form)
+	if valid:
 		username = form.username.data
 		first_name = form.first_name.data
 		last_name = form.last_name.data
@@ -75,11 +111,19 @@ def register():
 		password = form.password.data
 		displayname = first_name + " " + last_name
 
-		result = crowdServer.add_user(username, first_name=first_name, last_name=last_name, password=password,
-									email=email,
-									displayname=displayname)
+		try:
+			result = crowdServer.add_user(username, first_name=first_name, last_name=last_name, password=password,
+										email=email,
+										displayname=displayname)
+		except CrowdUnavailableError:
+			flash(CROWD_UNAVAILABLE_MESSAGE, 'danger')
+			return render_template('register.html', form=form)
 
 		if result:
+			user_cache.invalidate(username)
+			user_cache.invalidate(('missing', username))
+			remember_duplicate('username', username, True)
+			remember_duplicate('email', email, True)
 			flash("You are now successfully registered", 'success')
 			return redirect(url_for('login'))
 		else:
@@ -89,9 +133,28 @@ def register():
 		return render_template('register.html', form=form)
 
 
+@app.route('/status')
+@login_required
+@admin_permission.require(http_exception=403)
+def status():
+	stats = {
+		'crowd': crowdServer.stats(),
+		'user_cache': user_cache.stats(),
+		'session_cache': session_cache.stats(),
+		'admin_group': admin_group.stats(),
+		'presence_index': filestore.presence_index.stats(),
+		'previews': previews.preview_queue.stats(),
+		'compression': compression.compression_queue.stats(),
+		'upload_sessions': uploads.session_collector.stats(),
+		'blob_cache': blob_cache.stats()
+	}
+	return json.dumps(stats), 200, {'ContentType': 'application/json'}
+
+
 @app.route('/profile')
 @login_required
 def profile():
+	# The profile is edited in crowd, which does not tell us, so changes show up within USER_CACHE_TTL
 	response = make_response(redirect('https://my.cs-students.nl/crowd/console/user/viewprofile.action'))
 	return response
 
@@ -122,7 +185,7 @@ def subjectfiles(subject_id, subfolder):
 				foldersToShow = util.get_folders_to_show(subject_id, subfolder)
 				filesToShow = util.get_files_to_show(subject_id, subfolder, current_user.get_id())
 				return render_template('files.html', folders=foldersToShow, files=filesToShow,
-									subjectDataSet=util.get_subject_data_set(subject_id))
+									subjectDataSet=subject_data_set)
 			else:
 				return render_template('404.html', reason="nopath"), 404
 		elif len(subfolder.split('/')) == 2:
@@ -131,7 +194,7 @@ def subjectfiles(subject_id, subfolder):
 				foldersToShow = util.get_folders_to_show(subject_id, subfolder)
 				filesToShow = util.get_files_to_show(subject_id, subfolder, current_user.get_id())
 				return render_template('files.html', folders=foldersToShow, files=filesToShow,
-										subjectDataSet=util.get_subject_data_set(subject_id))
+										subjectDataSet=subject_data_set)
 			else:
 				return render_template('404.html', reason="nopath"), 404
 		elif len(subfolder.split('/')) == 3:
@@ -141,7 +204,7 @@ def subjectfiles(subject_id, subfolder):
 				foldersToShow = util.get_folders_to_show(subject_id, subfolder)
 				filesToShow = util.get_files_to_show(subject_id, subfolder, current_user.get_id())
 				return render_template('files.html', folders=foldersToShow, files=filesToShow,
-									subjectDataSet=util.get_subject_data_set(subject_id))
+									subjectDataSet=subject_data_set)
 			else:
 				return render_template('404.html', reason="nopath"), 404
 		else:
@@ -151,23 +214,73 @@ def subjectfiles(subject_id, subfolder):
 @app.route(app.config['FILESTORE_PATH'] + '/<file_hash>')
 @login_required
 def get_file(file_hash):
-	if util.file_exists(file_hash):
+	path = filestore.find_file(file_hash)
+	if path:
 		file = File.query.filter(File.file_hash == file_hash).first()
 		if not file:
 			return make_response('File not Found', 404)
 		file = file.__dict__
 		filename = file['name']
 		filetype = file['type']
-		path = os.path.join(app.config['FILESTORE_DIR'], file_hash)
-		resp = make_response(send_file(path, mimetype=filetype,
-									as_attachment=False,
-									attachment_filename=filename))
-		resp.headers['Content-Disposition'] = "inline; filename=%s" % filename
-		return resp
+		# the proxy reads from the filestore itself when it sends files
+		send_path = path if app.config['FILESTORE_OFFLOAD'] else blob_cache.get_path(file_hash, path)
+		if not compression.is_compressible(filetype):
+			# the url is the hash of the content, so the hash is a strong etag for it
+			return transfer.send_stored_file(send_path, file_hash, filetype, filename, file['upload_date'],
+											fallback_path=path)
+
+		# each variant is a different sequence of bytes, so it gets an etag of its own for conditional and range requests
+		headers = {'Vary': 'Accept-Encoding'}
+		gzip_path = compression.find_gzip_variant(file_hash)
+		if gzip_path:
+			gzip_headers = dict(headers)
+			gzip_headers['Content-Encoding'] = 'gzip'
+			try:
+				return transfer.send_stored_file(gzip_path, file_hash + '-gzip', filetype, filename,
+												file['upload_date'], extra_headers=gzip_headers)
+			except FileNotFoundError:
+				# the variant was removed after it was found, send the file itself
+				pass
+		return transfer.send_stored_file(send_path, file_hash, filetype, filename, file['upload_date'],
+										extra_headers=headers, fallback_path=path)
 
 	else:
 		return make_response('File not Found', 404)
 
+
+@app.route('/preview/<file_hash>')
+@login_required
+def get_preview(file_hash):
+	preview = previews.find_preview(file_hash)
+	file = File.query.filter(File.file_hash == file_hash).first() if preview else None
+	if not file:
+		# no preview (yet), the page shows the icon of the file instead
+		return make_response('Preview not Found', 404)
+	path, mimetype = preview
+	return transfer.send_stored_file(path, file_hash + '-preview', mimetype, 'preview-' + file.name, file.upload_date)
+
+
+@app.route('/download/<subject_id>/<path:subfolder>')
+@login_required
+def download_folder(subject_id, subfolder):
+	if subfolder.split('/')[0] not in app.config['SUBJECT_SUBFOLDERS']:
+		return render_template('404.html', reason="nopath"), 404
+	entries = util.get_archive_entries(subject_id, subfolder)
+	if not entries:
+		return render_template('404.html', reason="nopath"), 404
+
+	filename = "%s-%s.zip" % (subject_id, subfolder.replace('/', '-'))
+	key = archive.get_archive_key(entries)
+	cached_path = archive.get_cached_archive(key)
+	if cached_path:
+		last_modified = max(entry[4] for entry in entries)
+		return transfer.send_stored_file(cached_path, key, 'application/zip', filename, last_modified, 'attachment')
+
+	resp = Response(stream_with_context(archive.generate_and_cache_zip(entries, key)), mimetype='application/zip')
+	resp.headers['Content-Disposition'] = "attachment; filename=%s" % filename
+	return resp
+
+
 @app.route('/favorites')
 @login_required
 def favorites():
@@ -236,50 +349,20 @@ def vote_file():
 			file_id = request.json['fileid']
 			newVote = request.json['vote']
 			if type(file_id) == int and type(newVote) == int:
-				file_for_vote = File.query.filter(File.file_id == file_id).first()
-				if not file_for_vote:
-					return make_response('Invalid FileID', 400)
-				file_for_vote = file_for_vote.__dict__
-				if util.file_exists(file_for_vote['file_hash']):
-					currentVote = Vote.query.filter(Vote.file_id == file_id).filter(Vote.user_username == username).first()
-					if currentVote is None:
-						if newVote != 0:
-							ins = Vote(file_id=file_id, user_username=username, vote=newVote)
-							db.session.add(ins)
-							db.session.commit()
-							return json.dumps({'success': True}), 200, {'ContentType': 'application/json'}
-						else:
-							return make_response('Vote is same as current vote', 400)
-					elif currentVote.vote == -1:
-						if newVote == 1:
-							existing_vote = Vote.query.filter(Vote.user_username == username).filter(
-								Vote.file_id == file_id).first()
-							existing_vote.vote = newVote
-							db.session.commit()
-							return json.dumps({'success': True}), 200, {'ContentType': 'application/json'}
-						elif newVote == 0:
-							Vote.query.filter(Vote.file_id == file_id).filter(Vote.user_username == username).delete()
-							db.session.commit()
-							return json.dumps({'success': True}), 200, {'ContentType': 'application/json'}
-						else:
-							return make_response('Vote is same as current vote', 400)
-					elif currentVote.vote == 1:
-						if newVote == -1:
-							existing_vote = Vote.query.filter(Vote.user_username == username).filter(
-								Vote.file_id == file_id).first()
-							existing_vote.vote = newVote
-							db.session.commit()
-							return json.dumps({'success': True}), 200, {'ContentType': 'application/json'}
-						elif newVote == 0:
-							Vote.query.filter(Vote.file_id == file_id).filter(Vote.user_username == username).delete()
-							db.session.commit()
-							return json.dumps({'success': True}), 200, {'ContentType': 'application/json'}
-						else:
-							return make_response('Vote is same as current vote', 400)
-					else:
-						return make_response('Current vote cannot be found', 500)
-				else:
+				if newVote not in (-1, 0, 1):
+					return make_response('Data types incorrect', 400)
+				# the file and the current vote of the user in one query
+				file_for_vote = db.session.query(File.file_hash, Vote.vote).outerjoin(
+					Vote, (Vote.file_id == File.file_id) & (Vote.user_username == username)).filter(
+					File.file_id == file_id).first()
+				if not file_for_vote or not util.file_exists(file_for_vote.file_hash):
 					return make_response('Invalid FileID', 400)
+				currentVote = file_for_vote.vote or 0
+				if currentVote == newVote:
+					return make_response('Vote is same as current vote', 400)
+				if not util.set_user_file_vote(file_id, username, currentVote, newVote):
+					return make_response('Vote was changed at the same time, please try again', 409)
+				return json.dumps({'success': True}), 200, {'ContentType': 'application/json'}
 			else:
 				return make_response('Data types incorrect', 400)
 		else:
@@ -319,31 +402,15 @@ def upload_file_form():
 		if not util.get_subject_data_set(subject_id):
 			return json.dumps("Subject does not exist"), 400, {'ContentType': 'application/json'}
 
-		file.save(os.path.join(app.root_path, app.config['FILESTORE_DIR'], filename))
-		sha1 = hashlib.sha1()
-
-		f = open(os.path.join(app.root_path, app.config['FILESTORE_DIR'], filename), 'rb')
-		sha1.update(f.read())
-		f.close()
-		file_hash = sha1.hexdigest()
-		os.rename(os.path.join(app.root_path, app.config['FILESTORE_DIR'], filename),
-				os.path.join(app.root_path, app.config['FILESTORE_DIR'], file_hash))
-
 		if subject_id and category:
-			display_path = category
-			if category == "exams" or category == "homework":
-				if opt1 and opt2 != "type":
-					YearPeriod = opt1 + "-" + str(int(opt1) + 1)
-					display_path = display_path + "/" + YearPeriod + "/" + opt2
-				else:
-					return json.dumps("Second set of options not selected"), 400, {'ContentType': 'application/json'}
-			if File.query.filter(File.file_hash == file_hash).all():
-				return json.dumps("That file is already uploaded"), 400, {
-					'ContentType': 'application/json'}
-			db_file = File(file_hash=file_hash, name=filename, display_path=display_path,
-						subject_id=subject_id, uploader_username=uploader_username, type=file.content_type)
-			db.session.add(db_file)
-			db.session.commit()
+			display_path = util.get_upload_display_path(category, opt1, opt2)
+			if display_path is None:
+				return json.dumps("Second set of options not selected"), 400, {'ContentType': 'application/json'}
+
+			error = uploads.store_upload(file.stream, filename, file.content_type, subject_id, display_path,
+										uploader_username)
+			if error:
+				return json.dumps(error), 400, {'ContentType': 'application/json'}
 			return json.dumps({'success': True}), 200, {'ContentType': 'application/json'}
 		else:
 			return json.dumps("No subject or category selected"), 400, {'ContentType': 'application/json'}
@@ -351,6 +418,70 @@ def upload_file_form():
 		return abort(405)
 
 
+@app.route('/upload/sessions', methods=["POST"])
+@login_required
+def create_upload_session():
+	subject_id = request.form.get('subject')
+	category = request.form.get('filetype')
+	filename = request.form.get('name', '')
+	mimetype = request.form.get('type') or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+	size = request.form.get('size', type=int)
+	if filename == '' or size is None or size < 0:
+		return json.dumps("No File attached"), 400, {'ContentType': 'application/json'}
+	if size > app.config['UPLOAD_SESSION_MAX_SIZE']:
+		return json.dumps("That file is too large"), 413, {'ContentType': 'application/json'}
+	if not subject_id or category not in app.config['SUBJECT_SUBFOLDERS']:
+		return json.dumps("No subject or category selected"), 400, {'ContentType': 'application/json'}
+	if not Subject.query.filter(Subject.subject_id == subject_id).first():
+		return json.dumps("Subject does not exist"), 400, {'ContentType': 'application/json'}
+	display_path = util.get_upload_display_path(category, request.form.get('opt1'), request.form.get('opt2'))
+	if display_path is None:
+		return json.dumps("Second set of options not selected"), 400, {'ContentType': 'application/json'}
+
+	upload = uploads.create_session(filename, mimetype, size, subject_id, display_path, current_user.get_id())
+	return json.dumps(upload), 200, {'ContentType': 'application/json'}
+
+
+@app.route('/upload/sessions/<upload_id>', methods=["GET", "DELETE"])
+@login_required
+def upload_session(upload_id):
+	upload = uploads.get_session(upload_id, current_user.get_id())
+	if upload is None:
+		return json.dumps("Upload not found"), 404, {'ContentType': 'application/json'}
+	if request.method == "DELETE":
+		uploads.remove_session(upload)
+		return json.dumps({'success': True}), 200, {'ContentType': 'application/json'}
+	upload['received'] = uploads.get_received_chunks(upload)
+	return json.dumps(upload), 200, {'ContentType': 'application/json'}
+
+
+@app.route('/upload/sessions/<upload_id>/chunks/<int:index>', methods=["PUT"])
+@login_required
+def upload_chunk(upload_id, index):
+	upload = uploads.get_session(upload_id, current_user.get_id())
+	if upload is None:
+		return json.dumps("Upload not found"), 404, {'ContentType': 'application/json'}
+	checksum = request.headers.get('X-Chunk-SHA1', '').lower()
+	if not filestore.is_file_hash(checksum):
+		return json.dumps("No checksum for the chunk"), 400, {'ContentType': 'application/json'}
+	error = uploads.receive_chunk(upload, index, request.stream, checksum)
+	if error:
+		return json.dumps(error), 400, {'ContentType': 'application/json'}
+	return json.dumps({'success': True}), 200, {'ContentType': 'application/json'}
+
+
+@app.route('/upload/sessions/<upload_id>/finish', methods=["POST"])
+@login_required
+def finish_upload_session(upload_id):
+	upload = uploads.get_session(upload_id, current_user.get_id())
+	if upload is None:
+		return json.dumps("Upload not found"), 404, {'ContentType': 'application/json'}
+	error = uploads.finish_session(upload)
+	if error:
+		return json.dumps(error), 400, {'ContentType': 'application/json'}
+	return json.dumps({'success': True}), 200, {'ContentType': 'application/json'}
+
+
 @app.route('/removefile', methods=["POST"])
 def removeFile():
 	if current_user.is_authenticated and current_user.is_active and current_user.get_admin:
@@ -359,7 +490,9 @@ def removeFile():
 			if fileid is not None and type(fileid) is int:
 				file = File.query.filter(File.file_id == fileid).first()
 				if file:
-					os.remove(os.path.join(app.root_path, app.config['FILESTORE_DIR'], file.file_hash))
+					filestore.remove_file(file.file_hash)
+					blob_cache.discard(file.file_hash)
+					folders.remove_file(file.subject_id, file.display_path, file.size)
 					File.query.filter(File.file_id == fileid).delete()
 					db.session.commit()
 					return json.dumps({'success': True}), 200, {'ContentType': 'application/json'}
@@ -7,9 +7,35 @@ SQLALCHEMY_TRACK_MODIFICATIONS = False
 
 # Files configuration
 FILESTORE_DIR = "filestore"  # folder name on disk
+FILESTORE_FANOUT = 2  # levels of sub-folders (named after 2 characters of the hash each) files are spread over
+FILESTORE_SCAN_INTERVAL = 600  # seconds between reconciling the in-memory index of stored files with the disk
 FILESTORE_PATH = "/file"   # URL path prefix
+FILESTORE_CACHE_CONTROL = "private, max-age=31536000, immutable"  # files never change, but require a login
+FILESTORE_OFFLOAD = None  # None to send files from python, or let the proxy send them: "x-accel-redirect" or "x-sendfile"
+FILESTORE_ACCEL_PREFIX = "/protected-filestore"  # internal nginx location serving FILESTORE_DIR (x-accel-redirect)
+BLOB_CACHE_DIR = None  # absolute path of a local folder to cache files in when FILESTORE_DIR is on a shared disk
+BLOB_CACHE_SIZE = 2 * 1024 * 1024 * 1024  # 2GB, max total size of the files in BLOB_CACHE_DIR
 MAX_UPLOAD_SIZE = 32 * 1024 * 1024  # 32MB
+UPLOAD_CHUNK_SIZE = 64 * 1024  # bytes read at a time while receiving and hashing an upload
+UPLOAD_SESSION_DIR = "upload_sessions"  # folder name on disk for the chunks of resumable uploads
+UPLOAD_SESSION_CHUNK_SIZE = 8 * 1024 * 1024  # 8MB, size of the chunks files larger than MAX_UPLOAD_SIZE are sent in
+UPLOAD_SESSION_MAX_SIZE = 4 * 1024 * 1024 * 1024  # 4GB, max size of a file uploaded in chunks
+UPLOAD_SESSION_TTL = 24 * 60 * 60  # seconds without a new chunk before an upload is considered abandoned
+UPLOAD_SESSION_COLLECT_INTERVAL = 60 * 60  # seconds between removing abandoned uploads
 INITIAL_YEAR = 2010  # year for which files are stored
+ARCHIVE_CACHE_DIR = "archive_cache"  # folder name on disk for recently downloaded folder archives
+ARCHIVE_CACHE_SIZE = 1024 * 1024 * 1024  # 1GB, max total size of cached archives, 0 disables the cache
+PREVIEW_WORKERS = 2  # processes generating previews of uploaded files
+PREVIEW_QUEUE_SIZE = 256  # max number of files waiting for a preview, uploads beyond that get none
+PREVIEW_SIZE = 256  # width and height in pixels of the square thumbnails fit in
+PREVIEW_TEXT_LINES = 20  # lines of text in the snippet of text files and PDFs that cannot be rendered
+PREVIEW_TEXT_BYTES = 4096  # bytes read from a text file for its snippet
+PREVIEW_TIMEOUT = 30  # seconds before rendering a PDF page is given up
+GZIP_WORKERS = 1  # processes storing gzip compressed variants of uploaded files
+GZIP_QUEUE_SIZE = 256  # max number of files waiting to be compressed, uploads beyond that are sent uncompressed
+GZIP_MIN_SIZE = 1024  # bytes, smaller files are not worth compressing
+GZIP_MIN_SAVING = 0.2  # fraction of the size a gzip variant has to save to be stored
+GZIP_LEVEL = 9  # compression is done once per file, off the request path, so use the best level
 FILE_ICONS = {"audio/": "file-audio", "video/": "file-video", "image/": "file-image", "text/": "file-alt",
 			"application/pdf": "file-pdf", "application/msword": "file-word",  "application/mspowerpoint": "file-powerpoint",
 			"application/excel": "file-excel", "application/zip": "file-archive", "default": "file"}
@@ -22,3 +48,25 @@ CROWD_API_URL = "http://my.cs-students.nl:8095/crowd/"
 CROWD_API_USER = ""
 CROWD_API_PASS = ""
 CROWD_API_ADMIN_GROUP = "Admin"  # The name of the administrators group in crowd
+ADMIN_GROUP_REFRESH_INTERVAL = 60  # seconds between reloading the members of the administrators group
+CROWD_AUTH_MODE = "password"  # "password" checks the password once, "session" keeps a crowd SSO session per login
+CROWD_SESSION_CACHE_SIZE = 4096  # max number of validated session tokens kept in memory
+CROWD_SESSION_VALIDATION_TTL = 60  # seconds before a session token is validated against crowd again
+CROWD_CONNECT_TIMEOUT = 3.05  # seconds to wait for a connection to crowd
+CROWD_READ_TIMEOUT = 10  # seconds to wait for crowd to respond
+CROWD_POOL_SIZE = 16  # pooled connections to crowd, should be at least the number of worker threads
+CROWD_RETRIES = 2  # times a failed GET request is retried
+CROWD_RETRY_BACKOFF = 0.1  # base delay in seconds between retries, doubled (with jitter) every retry
+CROWD_BREAKER_THRESHOLD = 5  # consecutive failures before we stop sending requests to crowd
+CROWD_BREAKER_RESET = 30  # seconds before a request is sent to crowd again after the breaker opened
+
+# User cache configuration
+USER_CACHE_SIZE = 2048  # max number of user profiles kept in memory
+USER_CACHE_TTL = 300  # seconds before a cached profile is fetched from crowd again, so profile edits show up within it
+USER_CACHE_MISSING_TTL = 600  # seconds to remember that an uploader no longer exists in crowd
+CROWD_LOOKUP_WORKERS = 8  # max number of concurrent crowd requests when resolving many users at once
+
+# Registration duplicate check cache configuration
+REGISTRATION_CACHE_SIZE = 4096  # max number of usernames and emails kept in memory
+REGISTRATION_POSITIVE_TTL = 3600  # seconds to remember that a username or email is taken
+REGISTRATION_NEGATIVE_TTL = 30  # seconds to remember that a username or email is still free
@@ -0,0 +1,85 @@
+# Checks the headers Markis sends for every FILESTORE_OFFLOAD mode, without needing a real proxy
+#
+# Requests a stored file through the flask test client (with logins disabled) and verifies
+# that the proxy is told which file to send, with the right content type and disposition.
+#
+# Usage: python tools/check_offload.py [file hash]
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from Markis import app
+from Markis.models import File
+from Markis.util import filestore
+
+
+def find_stored_file(file_hash=None):
+	"""Find a File that is present in the filestore
+	Args:
+		file_hash: optional hash of the file to use
+	Returns:
+		File: The file, or None if no stored file can be found
+	"""
+
+	query = File.query if file_hash is None else File.query.filter(File.file_hash == file_hash)
+	for file in query.limit(1000):
+		if filestore.find_file(file.file_hash):
+			return file
+	return None
+
+
+def check_mode(client, file, mode):
+	"""Request a file with a FILESTORE_OFFLOAD mode and check the response
+	Returns:
+		list: Descriptions of the problems found
+	"""
+
+	app.config['FILESTORE_OFFLOAD'] = mode
+	url = app.config['FILESTORE_PATH'] + "/" + file.file_hash
+	response = client.get(url)
+	path = filestore.find_file(file.file_hash)
+	expected = {
+		'Content-Type': file.type,
+		'Content-Disposition': "inline; filename=%s" % file.name,
+		'ETag': '"%s"' % file.file_hash
+	}
+	if mode == 'x-accel-redirect':
+		relative_path = os.path.relpath(path, filestore.get_filestore_dir()).replace(os.sep, '/')
+		expected['X-Accel-Redirect'] = app.config['FILESTORE_ACCEL_PREFIX'].rstrip('/') + '/' + relative_path
+	else:
+		expected['X-Sendfile'] = path
+
+	problems = []
+	if response.status_code != 200:
+		problems.append("status is %s instead of 200" % response.status_code)
+	if response.data:
+		problems.append("the response has a body of %d bytes" % len(response.data))
+	for header, value in expected.items():
+		if not response.headers.get(header, '').startswith(value):
+			problems.append("%s is %r instead of %r" % (header, response.headers.get(header), value))
+	if client.get(url, headers={'If-None-Match': expected['ETag']}).status_code != 304:
+		problems.append("If-None-Match is not answered with 304")
+	return problems
+
+
+def main():
+	app.config['LOGIN_DISABLED'] = True
+	file = find_stored_file(sys.argv[1] if len(sys.argv) > 1 else None)
+	if file is None:
+		sys.exit("No stored file found, upload one first")
+
+	failed = False
+	with app.test_client() as client:
+		for mode in ('x-accel-redirect', 'x-sendfile'):
+			problems = check_mode(client, file, mode)
+			print("%-17s %s" % (mode, "OK" if not problems else "FAILED"))
+			for problem in problems:
+				print("    " + problem)
+			failed = failed or bool(problems)
+	sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+	main()
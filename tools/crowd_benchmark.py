@@ -0,0 +1,100 @@
+# Measures how Markis page latency depends on Crowd latency
+#
+# Starts a fake Crowd (see fake_crowd.py) and times logging in, a subject page and a
+# file listing of a running Markis instance for every configured Crowd latency.
+# Markis has to be configured with CROWD_API_URL = "http://127.0.0.1:<crowd-port>/crowd/",
+# CROWD_API_USER = "markis" and CROWD_API_PASS = "markis".
+#
+# Usage: python tools/crowd_benchmark.py --subject 2IPC0 --folder exams/2016-2017/questions
+
+import argparse
+import statistics
+import time
+import requests
+
+from fake_crowd import FakeCrowd, PASSWORD, serve
+
+
+def measure(crowd, session_factory, url, requests_per_scenario, method="get", data=None):
+	"""Time a request several times
+	Args:
+		crowd: The FakeCrowd, used to count the crowd requests made
+		session_factory: Function returning the requests Session to send the request with
+		url: The url to request
+		requests_per_scenario: How many times to send the request
+		method: The HTTP method
+		data: Form data to send
+	Returns:
+		dict:
+			median, p95 and mean latency in milliseconds, and crowd requests per page
+	"""
+
+	timings = []
+	crowd_requests = crowd.requests
+	for i in range(requests_per_scenario):
+		session = session_factory()
+		start = time.perf_counter()
+		response = session.request(method, url, data=data, allow_redirects=False)
+		timings.append((time.perf_counter() - start) * 1000)
+		if response.status_code >= 400:
+			raise RuntimeError("%s %s returned %s" % (method.upper(), url, response.status_code))
+	timings.sort()
+	return {
+		'median': statistics.median(timings),
+		'p95': timings[int(0.95 * (len(timings) - 1))],
+		'mean': statistics.mean(timings),
+		'crowd': (crowd.requests - crowd_requests) / requests_per_scenario
+	}
+
+
+def log_in(markis_url, username):
+	"""Log a user in to Markis
+	Returns:
+		Session: a requests Session carrying the login cookie
+	"""
+
+	session = requests.Session()
+	response = session.post(markis_url + "/login", data={'username': username, 'password': PASSWORD},
+							allow_redirects=False)
+	if response.status_code != 302:
+		raise RuntimeError("Logging in as %s failed, is Markis using the fake crowd?" % username)
+	return session
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark Markis against a fake crowd with varying latency")
+	parser.add_argument("--markis-url", default="http://127.0.0.1:5000")
+	parser.add_argument("--crowd-port", type=int, default=8095)
+	parser.add_argument("--subject", required=True, help="subject id of the subject page to load")
+	parser.add_argument("--folder", required=True, help="folder of the subject to list, e.g. exams/2016-2017/questions")
+	parser.add_argument("--latencies", default="0,0.01,0.05,0.1,0.2", help="comma separated crowd latencies (s)")
+	parser.add_argument("--requests", type=int, default=20, help="requests per scenario and latency")
+	parser.add_argument("--users", type=int, default=100, help="number of synthetic crowd users")
+	args = parser.parse_args()
+
+	crowd = FakeCrowd(args.users)
+	server = serve(crowd, port=args.crowd_port)
+	markis_url = args.markis_url.rstrip("/")
+	subject_url = "%s/subject/%s/" % (markis_url, args.subject)
+	listing_url = "%s/subject/%s/%s" % (markis_url, args.subject, args.folder)
+
+	print("%-10s %-10s %10s %10s %10s %10s" % ("crowd (s)", "scenario", "median ms", "p95 ms", "mean ms", "crowd/req"))
+	try:
+		for latency in [float(latency) for latency in args.latencies.split(",")]:
+			crowd.latency = latency
+			session = log_in(markis_url, "user0000")
+			scenarios = [
+				('login', measure(crowd, requests.Session, markis_url + "/login", args.requests, "post",
+								{'username': "user0001", 'password': PASSWORD})),
+				('subject', measure(crowd, lambda: session, subject_url, args.requests)),
+				('listing', measure(crowd, lambda: session, listing_url, args.requests))
+			]
+			for name, result in scenarios:
+				print("%-10s %-10s %10.1f %10.1f %10.1f %10.2f" % (latency, name, result['median'], result['p95'],
+																	result['mean'], result['crowd']))
+	finally:
+		server.shutdown()
+
+
+if __name__ == "__main__":
+	main()
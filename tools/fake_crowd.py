@@ -0,0 +1,258 @@
+# Stand-in for the Crowd REST server, for development and benchmarking without the hosted Crowd
+#
+# Implements the parts of /rest/usermanagement/latest that Markis uses, seeded with
+# synthetic users and groups. Every request can be delayed and/or failed on purpose.
+#
+# Usage: python tools/fake_crowd.py --port 8095 --users 500 --latency 0.05 --error-rate 0.01
+# and set CROWD_API_URL = "http://127.0.0.1:8095/crowd/" in /instance/config.py
+
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+REST_PATH = "/rest/usermanagement/latest"
+PASSWORD = "password"  # password of every seeded user
+
+
+class FakeCrowd(object):
+	"""In-memory Crowd directory: users, (nested) groups and SSO sessions"""
+
+	def __init__(self, users=100, latency=0.0, error_rate=0.0, app_name="markis", app_pass="markis",
+				admin_group="Admin"):
+		self.latency = latency
+		self.error_rate = error_rate
+		self.app_name = app_name
+		self.app_pass = app_pass
+		self.requests = 0
+		self.users = {}
+		self.passwords = {}
+		self.groups = {}
+		self.sessions = {}
+		self._lock = threading.Lock()
+		self.seed(users, admin_group)
+
+	def seed(self, number_of_users, admin_group):
+		"""Create synthetic users, an admin group with a nested sub-group, and a students group
+		Args:
+			number_of_users: The number of users (user0000, user0001, ...) to create
+			admin_group: The name of the administrators group
+		"""
+
+		self.add_user("admin", "Markis", "Admin", "admin@example.com", PASSWORD)
+		for i in range(number_of_users):
+			self.add_user("user%04d" % i, "Synthetic", "User %d" % i, "user%04d@example.com" % i, PASSWORD)
+
+		nested_admins = admin_group + "-nested"
+		self.groups[admin_group] = {"users": {"admin"}, "groups": {nested_admins}}
+		self.groups[nested_admins] = {"users": set(list(self.users)[1:3]), "groups": set()}
+		self.groups["students"] = {"users": set(self.users), "groups": set()}
+
+	def add_user(self, username, first_name, last_name, email, password, display_name=None):
+		"""Add a user to the directory
+		Returns:
+			dict: The created user
+		"""
+
+		user = {"name": username, "first-name": first_name, "last-name": last_name,
+				"display-name": display_name or first_name + " " + last_name, "email": email, "active": True}
+		self.users[username] = user
+		self.passwords[username] = password
+		return user
+
+	def direct_groups(self, username):
+		return [name for name, group in self.groups.items() if username in group["users"]]
+
+	def nested_groups(self, username):
+		found = set(self.direct_groups(username))
+		changed = True
+		while changed:
+			parents = {name for name, group in self.groups.items() if group["groups"] & found}
+			changed = not parents <= found
+			found |= parents
+		return sorted(found)
+
+	def nested_group_users(self, groupname):
+		users = set()
+		pending = [groupname]
+		seen = set()
+		while pending:
+			name = pending.pop()
+			if name in seen or name not in self.groups:
+				continue
+			seen.add(name)
+			users |= self.groups[name]["users"]
+			pending.extend(self.groups[name]["groups"])
+		return sorted(users)
+
+	def create_session(self, username, password):
+		if self.passwords.get(username) != password:
+			return None
+		token = uuid.uuid4().hex
+		self.sessions[token] = username
+		return {"token": token, "user": self.users[username]}
+
+
+class FakeCrowdHandler(BaseHTTPRequestHandler):
+	"""Routes Crowd REST requests to the FakeCrowd of the server"""
+
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		self.handle_request("GET")
+
+	def do_POST(self):
+		self.handle_request("POST")
+
+	def do_PUT(self):
+		self.handle_request("PUT")
+
+	def do_DELETE(self):
+		self.handle_request("DELETE")
+
+	def handle_request(self, method):
+		crowd = self.server.crowd
+		length = int(self.headers.get("Content-Length") or 0)
+		body = self.rfile.read(length) if length else b""
+		with crowd._lock:
+			crowd.requests += 1
+
+		if crowd.latency:
+			time.sleep(crowd.latency)
+		if not self.is_authorized(crowd):
+			return self.respond(401, {"reason": "APPLICATION_ACCESS_DENIED"})
+		if random.random() < crowd.error_rate:
+			return self.respond(503, {"reason": "INJECTED_ERROR"})
+
+		url = urlparse(self.path)
+		if REST_PATH not in url.path:
+			return self.respond(404, {"reason": "NOT_FOUND"})
+		path = url.path.split(REST_PATH, 1)[1]
+		params = {key: values[0] for key, values in parse_qs(url.query).items()}
+		data = json.loads(body.decode("utf-8")) if body else {}
+		with crowd._lock:
+			status, response = self.route(crowd, method, path, params, data)
+		self.respond(status, response)
+
+	def is_authorized(self, crowd):
+		expected = base64.b64encode(("%s:%s" % (crowd.app_name, crowd.app_pass)).encode()).decode()
+		return self.headers.get("Authorization") == "Basic " + expected
+
+	def route(self, crowd, method, path, params, data):
+		"""Handle a request on the in-memory directory
+		Returns:
+			tuple:
+				The status code and the JSON response body (None for no body)
+		"""
+
+		not_found = (404, {"reason": "NOT_FOUND"})
+		username = params.get("username")
+
+		if path == "/user" and method == "GET":
+			if "email" in params:
+				found = [u for u in crowd.users.values() if u["email"].lower() == params["email"].lower()]
+				return (200, found[0]) if found else not_found
+			return (200, crowd.users[username]) if username in crowd.users else not_found
+		if path == "/user" and method == "POST":
+			if data.get("name") in crowd.users:
+				return 400, {"reason": "INVALID_USER", "message": "User already exists"}
+			crowd.add_user(data["name"], data["first-name"], data["last-name"], data["email"],
+						data["password"]["value"], data.get("display-name"))
+			return 201, None
+		if path == "/user/group/direct" and method == "GET":
+			if username not in crowd.users:
+				return not_found
+			return 200, {"groups": [{"name": name} for name in crowd.direct_groups(username)]}
+		if path == "/user/group/direct" and method == "POST":
+			if username not in crowd.users or data.get("name") not in crowd.groups:
+				return not_found
+			crowd.groups[data["name"]]["users"].add(username)
+			return 201, None
+		if path == "/user/group/nested" and method == "GET":
+			if username not in crowd.users:
+				return not_found
+			return 200, {"groups": [{"name": name} for name in crowd.nested_groups(username)]}
+		if path == "/group/user/nested" and method == "GET":
+			if params.get("groupname") not in crowd.groups:
+				return not_found
+			return 200, {"users": [{"name": name} for name in crowd.nested_group_users(params["groupname"])]}
+		if path == "/authentication" and method == "POST":
+			if username in crowd.users and crowd.passwords[username] == data.get("value"):
+				return 200, crowd.users[username]
+			return 400, {"reason": "INVALID_USER_AUTHENTICATION"}
+		if path == "/session" and method == "POST":
+			session = crowd.create_session(data.get("username"), data.get("password"))
+			if session is None:
+				return 400, {"reason": "INVALID_USER_AUTHENTICATION"}
+			return 201, session
+		if path.startswith("/session/"):
+			token = path[len("/session/"):]
+			if token not in crowd.sessions:
+				return not_found
+			if method == "POST":
+				return 200, {"token": token, "user": crowd.users[crowd.sessions[token]]}
+			if method == "DELETE":
+				del crowd.sessions[token]
+				return 204, None
+		return not_found
+
+	def respond(self, status, response):
+		body = json.dumps(response).encode("utf-8") if response is not None else b""
+		self.send_response(status)
+		if body:
+			self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+def serve(crowd, host="127.0.0.1", port=8095):
+	"""Start serving a FakeCrowd in a background thread
+	Args:
+		crowd: The FakeCrowd to serve
+		host: The address to listen on
+		port: The port to listen on
+	Returns:
+		ThreadingHTTPServer: The running server, stop it with shutdown()
+	"""
+
+	server = ThreadingHTTPServer((host, port), FakeCrowdHandler)
+	server.daemon_threads = True
+	server.crowd = crowd
+	threading.Thread(target=server.serve_forever, name="fake-crowd", daemon=True).start()
+	return server
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Run a stand-in Crowd REST server")
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=8095)
+	parser.add_argument("--users", type=int, default=100, help="number of synthetic users to create")
+	parser.add_argument("--latency", type=float, default=0.0, help="seconds to delay every request")
+	parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail with 503")
+	parser.add_argument("--app-name", default="markis", help="CROWD_API_USER Markis authenticates with")
+	parser.add_argument("--app-pass", default="markis", help="CROWD_API_PASS Markis authenticates with")
+	parser.add_argument("--admin-group", default="Admin", help="CROWD_API_ADMIN_GROUP of Markis")
+	args = parser.parse_args()
+
+	crowd = FakeCrowd(args.users, args.latency, args.error_rate, args.app_name, args.app_pass, args.admin_group)
+	server = serve(crowd, args.host, args.port)
+	print("Fake crowd running, set CROWD_API_URL = \"http://%s:%s/crowd/\"" % (args.host, args.port))
+	print("Users: admin, user0000 ... user%04d, password: %s" % (args.users - 1, PASSWORD))
+	try:
+		while True:
+			time.sleep(3600)
+	except KeyboardInterrupt:
+		server.shutdown()
+
+
+if __name__ == "__main__":
+	main()